@@ -1,54 +1,277 @@
-"""MIUI Updates Tracker Database initialization"""
+"""MIUI Updates Tracker Database initialization
+
+Nothing is opened at import time. The configuration, SSH tunnel, engine and reflected metadata
+are created the first time a query needs them, through get_engine() / get_session().
+"""
 import logging
+import pickle
+import threading
 from pathlib import Path
+from contextlib import contextmanager
+from typing import Iterator, Optional
 
 import yaml
-from sqlalchemy import create_engine, MetaData, Table
+from sqlalchemy import create_engine, event, MetaData, Table
 from sqlalchemy.engine import Connection, Engine
-from sqlalchemy.orm import sessionmaker
-from sshtunnel import SSHTunnelForwarder
+from sqlalchemy.orm import scoped_session, sessionmaker, Session as _Session
 
 logger = logging.getLogger(__name__)
 logging.getLogger('sshtunnel.SSHTunnelForwarder').setLevel(logging.ERROR)
 logging.getLogger('paramiko.transport').setLevel(logging.ERROR)
 module_path = Path(__file__).parent
 tunnel = None
-# read db configuration file
-with open(module_path / 'config.yml', 'r') as f:
-    db_config = yaml.load(f, Loader=yaml.FullLoader)
-if db_config.get('local_db') is True:
-    engine: Engine = create_engine(db_config.get('local_connection_string'), pool_recycle=3600, pool_pre_ping=True)
-else:
-    tunnel = SSHTunnelForwarder(
+
+_db_config: Optional[dict] = None
+_engine: Optional[Engine] = None
+_connection: Optional[Connection] = None
+_metadata: Optional[MetaData] = None
+# guards the creation of the tunnel and the engine, which threads may request at the same time
+_engine_lock = threading.RLock()
+
+Session: sessionmaker = sessionmaker()
+SessionLocal = sessionmaker(autocommit=False, autoflush=False)
+# one session per thread, all sharing the engine connection pool
+session_registry: scoped_session = scoped_session(Session)
+# config.yml keys passed to create_engine when set
+POOL_OPTIONS = ('pool_size', 'max_overflow', 'pool_timeout')
+
+
+def configure(**config) -> None:
+    """
+    Override the database configuration before the first connection is made.
+    Keys are the same as in config.yml, e.g. configure(local_db=True, local_connection_string='sqlite://')
+    """
+    if _engine is not None:
+        raise RuntimeError("Database engine is already initialized, call close_db() first")
+    get_config().update(config)
+
+
+def get_config() -> dict:
+    """
+    Read db configuration file on first use
+    :return: configuration dict (empty if config.yml doesn't exist)
+    """
+    global _db_config
+    if _db_config is None:
+        config_file = module_path / 'config.yml'
+        if config_file.exists():
+            with open(config_file, 'r') as f:
+                _db_config = yaml.load(f, Loader=yaml.FullLoader) or {}
+        else:
+            _db_config = {}
+    return _db_config
+
+
+def _start_tunnel(db_config: dict):
+    # sshtunnel (and paramiko) are slow to import, so only pay for them when a tunnel is needed
+    from sshtunnel import SSHTunnelForwarder
+
+    ssh_tunnel = SSHTunnelForwarder(
         (db_config.get('db_server'), 22),
         ssh_username=db_config.get('ssh_username'), ssh_pkey=db_config.get('ssh_key'),
         remote_bind_address=('127.0.0.1', db_config.get('db_port'))
     )
-    tunnel.daemon_forward_servers = True
-    tunnel.start()
-    connection_string = db_config.get('db_connection_string').replace(
+    ssh_tunnel.daemon_forward_servers = True
+    ssh_tunnel.start()
+    return ssh_tunnel
+
+
+def get_connection_string() -> str:
+    """
+    Get the connection string of the configured database, starting the SSH tunnel if needed
+    :return: SQLAlchemy connection URL
+    """
+    global tunnel
+    db_config = get_config()
+    if db_config.get('snapshot'):
+        from .snapshot import snapshot_url
+        return snapshot_url(db_config['snapshot'])
+    if db_config.get('local_db') is True:
+        return db_config.get('local_connection_string')
+    with _engine_lock:
+        if tunnel is None:
+            tunnel = _start_tunnel(db_config)
+    return db_config.get('db_connection_string').replace(
         '$host', tunnel.local_bind_host).replace('$port', str(tunnel.local_bind_port))
-    engine: Engine = create_engine(connection_string, pool_recycle=3600, pool_pre_ping=True)
-logger.info(f"Connected to {engine.name} database at {engine.url}")
-connection: Connection = engine.connect()
-# connection.execute('SET GLOBAL connect_timeout=6000')
 
-# Create a MetaData instance
-metadata: MetaData = MetaData()
-# reflect db schema to MetaData
-metadata.reflect(bind=engine)
-metadata.create_all(engine)
 
-Session: sessionmaker = sessionmaker(bind=engine)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-session = Session()
+def _sqlite_concat(*args):
+    # same as MySQL CONCAT(): NULL if any argument is NULL
+    return None if None in args else ''.join(str(arg) for arg in args)
+
+
+def register_sqlite_functions(engine: Engine):
+    """
+    Register the MySQL functions used by the queries that SQLite doesn't have (CONCAT before SQLite 3.44)
+    :param engine: SQLite engine (or the sync_engine of an async engine)
+    """
+
+    @event.listens_for(engine, 'connect')
+    def _connect(dbapi_connection, connection_record):
+        dbapi_connection.create_function('concat', -1, _sqlite_concat)
+
+
+def get_pool_options() -> dict:
+    """
+    Get the connection pool options set in config.yml
+    :return: create_engine keyword arguments
+    """
+    db_config = get_config()
+    return {option: db_config[option] for option in POOL_OPTIONS if db_config.get(option) is not None}
+
+
+def _check_schema(engine: Engine):
+    # the models select columns added by migrations, queries fail until they are applied
+    from .migrations import missing_columns
+    with engine.connect() as connection:
+        missing = missing_columns(connection)
+    for table, columns in missing.items():
+        logger.error(f"Table {table} has no {', '.join(columns)} column, queries of its model will fail: "
+                     f"apply the pending migrations with python -m {__name__}.migrations")
+
+
+def get_engine() -> Engine:
+    """
+    Get the database engine, connecting on first use
+    :return: SQLAlchemy engine
+    """
+    global _engine
+    if _engine is not None:
+        return _engine
+    with _engine_lock:
+        if _engine is not None:
+            return _engine
+        engine = create_engine(get_connection_string(), pool_recycle=3600, pool_pre_ping=True,
+                               **get_pool_options())
+        if engine.dialect.name == 'sqlite':
+            register_sqlite_functions(engine)
+        config = get_config()
+        if config.get('snapshot'):
+            from .snapshot import register_snapshot_pragmas
+            register_snapshot_pragmas(engine)
+        if config.get('instrumentation'):
+            from .instrumentation import enable_from_config
+            enable_from_config(engine)
+        Session.configure(bind=engine)
+        SessionLocal.configure(bind=engine)
+        logger.info(f"Connected to {engine.name} database at {engine.url}")
+        _check_schema(engine)
+        # only published once fully set up, so that other threads never see a half configured engine
+        _engine = engine
+    return _engine
+
+
+def get_session() -> _Session:
+    """
+    Get the database session of the current thread, connecting on first use
+    :return: SQLAlchemy session
+    """
+    get_engine()
+    return session_registry()
+
+
+@contextmanager
+def session_scope() -> Iterator[_Session]:
+    """
+    Run a unit of work in the current thread's session: commit on success, rollback on error,
+    and remove the session at the end so that its objects and connection are released
+
+    with session_scope() as session:
+        session.add(update)
+    """
+    session = get_session()
+    try:
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session_registry.remove()
+
+
+def get_metadata() -> MetaData:
+    """
+    Get the reflected db schema. Reflection is done on first use only, and is cached on disk
+    when reflection_cache is set in config.yml.
+    :return: MetaData instance
+    """
+    global _metadata
+    if _metadata is None:
+        engine = get_engine()
+        cache_file = get_config().get('reflection_cache')
+        if cache_file and Path(cache_file).exists():
+            with open(cache_file, 'rb') as f:
+                _metadata = pickle.load(f)
+        else:
+            _metadata = MetaData()
+            _metadata.reflect(bind=engine)
+            if cache_file:
+                with open(cache_file, 'wb') as f:
+                    pickle.dump(_metadata, f)
+    return _metadata
+
+
+def get_table(name: str) -> Table:
+    """
+    Get a reflected table by name
+    :param name: table name
+    :return: Table object
+    """
+    metadata = get_metadata()
+    if name in metadata.tables:
+        return metadata.tables[name]
+    return Table(name, metadata, autoload_with=get_engine())
+
+
+def __getattr__(name: str):
+    # Backwards compatible module attributes, resolved lazily
+    global _connection
+    if name == 'db_config':
+        return get_config()
+    if name == 'engine':
+        return get_engine()
+    if name == 'session':
+        get_engine()
+        return session_registry
+    if name == 'connection':
+        if _connection is None:
+            _connection = get_engine().connect()
+        return _connection
+    if name == 'metadata':
+        return get_metadata()
+    if name in ('latest_updates', 'latest_firmware'):
+        return get_table(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
-latest_updates = Table("latest_updates", metadata, autoload_with=engine)
-latest_firmware = Table("latest_firmware", metadata, autoload_with=engine)
+def reset_after_fork():
+    """
+    Forget the engine, sessions and SSH tunnel inherited from a parent process, without closing their
+    connections or stopping the tunnel (they are still used by the parent), so that this process
+    connects with its own engine through its own tunnel
+    """
+    global tunnel, _engine, _connection, _engine_lock
+    # a parent thread may have held the lock when the process was forked
+    _engine_lock = threading.RLock()
+    if _engine is not None:
+        _engine.dispose(close=False)
+    _engine = None
+    _connection = None
+    tunnel = None
+    session_registry.registry.clear()
 
 
 def close_db():
-    connection.close()
-    engine.dispose()
-    if tunnel:
-        tunnel.stop()
+    global tunnel, _engine, _connection
+    session_registry.remove()
+    with _engine_lock:
+        if _connection is not None:
+            _connection.close()
+            _connection = None
+        if _engine is not None:
+            _engine.dispose()
+            _engine = None
+        if tunnel:
+            tunnel.stop()
+            tunnel = None
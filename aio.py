@@ -0,0 +1,309 @@
+"""
+Asyncio database functions, mirroring database.py and firmware.py
+
+They use their own async engine, built from the same config.yml and needing an async driver
+(aiomysql for MySQL, aiosqlite for SQLite). Each function runs in its own AsyncSession,
+so independent lookups can run concurrently:
+
+    latest, roms = await asyncio.gather(aio.get_device_latest('whyred'), aio.get_device_roms('whyred'))
+"""
+from typing import AsyncIterator, Awaitable, Callable, Iterable, List, Optional, Tuple, Union
+
+from sqlalchemy import Select
+from sqlalchemy.engine import URL, make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
+
+from . import get_config, get_connection_string, get_pool_options, queries, register_sqlite_functions
+from . import latest as _latest_maintenance  # noqa: F401, keeps updates_latest up to date on flush
+from .cache import result_cache
+from .instrumentation import enable_from_config, tagged
+from .models.device import Device
+from .models.firmware_update import Update as FirmwareUpdate
+from .models.miui_update import Update
+from .queries import LATEST_BRANCHES, Cursor
+from .registry import device_registry
+from .utils import IN_CHUNK_SIZE, chunked
+
+# Default async driver of each database backend
+ASYNC_DRIVERS = {
+    'mysql': 'aiomysql',
+    'sqlite': 'aiosqlite',
+    'postgresql': 'asyncpg',
+}
+
+_engine: Optional[AsyncEngine] = None
+AsyncSession: async_sessionmaker = async_sessionmaker(expire_on_commit=False)
+
+
+def get_async_connection_string() -> URL:
+    """
+    Get the configured connection string with its driver replaced by an async one,
+    async_driver from config.yml or the default driver of the backend
+    :return: SQLAlchemy connection URL
+    """
+    url = make_url(get_connection_string())
+    backend = url.get_backend_name()
+    driver = get_config().get('async_driver') or ASYNC_DRIVERS.get(backend)
+    if driver is None:
+        raise ValueError(f"No async driver known for {backend}, set async_driver in config.yml")
+    return url.set(drivername=f"{backend}+{driver}")
+
+
+def get_async_engine() -> AsyncEngine:
+    """
+    Get the async database engine, connecting on first use
+    :return: SQLAlchemy async engine
+    """
+    global _engine
+    if _engine is None:
+        _engine = create_async_engine(get_async_connection_string(), pool_recycle=3600, pool_pre_ping=True,
+                                      **get_pool_options())
+        if _engine.dialect.name == 'sqlite':
+            register_sqlite_functions(_engine.sync_engine)
+        if get_config().get('snapshot'):
+            from .snapshot import register_snapshot_pragmas
+            register_snapshot_pragmas(_engine.sync_engine)
+        enable_from_config(_engine.sync_engine)
+        AsyncSession.configure(bind=_engine)
+    return _engine
+
+
+async def close_async_db():
+    global _engine
+    if _engine is not None:
+        await _engine.dispose()
+        _engine = None
+
+
+def _session():
+    get_async_engine()
+    return AsyncSession()
+
+
+async def _all(statement: Select) -> List:
+    async with _session() as session:
+        return (await session.execute(statement)).all()
+
+
+async def _first(statement: Select, parameters: Optional[dict] = None):
+    async with _session() as session:
+        return (await session.execute(statement, parameters)).first()
+
+
+async def _scalar(statement: Select, parameters: Optional[dict] = None):
+    async with _session() as session:
+        return (await session.execute(statement, parameters)).scalar()
+
+
+async def _scalars(statement: Select) -> List:
+    async with _session() as session:
+        return (await session.execute(statement)).scalars().all()
+
+
+@tagged
+async def get_mi_website_ids() -> List:
+    return await _all(queries.mi_website_ids())
+
+
+@tagged
+async def get_fastboot_codenames() -> List:
+    return await _all(queries.fastboot_codenames())
+
+
+@tagged
+async def get_current_devices() -> List:
+    return await _all(queries.current_devices())
+
+
+@tagged
+async def get_devices() -> List:
+    return await _all(queries.devices())
+
+
+@tagged
+async def get_device_latest_version(codename: str):
+    return await _first(queries.DEVICE_LATEST_VERSION, {'codename': codename})
+
+
+@tagged
+async def get_devices_latest_version(codenames: Iterable[str]) -> dict:
+    latest = {}
+    for chunk in chunked(set(codenames), IN_CHUNK_SIZE):
+        latest.update((row.codename, row) for row in await _all(queries.devices_latest_version(chunk)))
+    return latest
+
+
+@tagged
+async def get_latest_versions(branch: str = "Stable") -> List:
+    return await _all(queries.latest_versions(branch))
+
+
+@tagged
+async def get_latest_updates(branch: str = "Stable") -> List:
+    return await _all(queries.latest_updates((branch,)))
+
+
+@tagged
+async def get_all_latest_updates() -> List:
+    return await _all(queries.latest_updates(LATEST_BRANCHES))
+
+
+@tagged
+async def get_device_latest(codename: str) -> List:
+    return await _all(queries.device_latest(codename))
+
+
+@tagged
+async def get_devices_latest(codenames: Iterable[str], chunk_size: int = 100) -> dict:
+    codenames = set(codenames)
+    latest = {codename: [] for codename in codenames}
+    for chunk in chunked(sorted(codenames), chunk_size):
+        for row in await _all(queries.devices_latest(chunk)):
+            for codename in chunk:
+                if row.codename.startswith(codename):
+                    latest[codename].append(row)
+    return latest
+
+
+@tagged
+async def get_device_roms(codename: str) -> List:
+    return await _all(queries.device_roms(codename))
+
+
+async def _iter_keyset(fetch_page: Callable[[Optional[Cursor]], Awaitable[List]], page_size: int) -> AsyncIterator:
+    cursor = None
+    while True:
+        page = await fetch_page(cursor)
+        for row in page:
+            yield row
+        if len(page) < page_size:
+            return
+        cursor = (page[-1].date, page[-1].id)
+
+
+@tagged
+async def get_device_roms_page(codename: str, cursor: Optional[Cursor] = None, page_size: int = 100) -> List:
+    return await _all(queries.device_roms_page(codename, cursor, page_size))
+
+
+@tagged
+def iter_device_roms(codename: str, page_size: int = 100) -> AsyncIterator:
+    return _iter_keyset(lambda cursor: get_device_roms_page(codename, cursor, page_size), page_size)
+
+
+@tagged
+async def get_codename(miui_name: str) -> Optional[str]:
+    if miui_name.endswith("PRE"):
+        miui_name = miui_name.replace("PRE", "")
+    device = await _scalar(queries.device_by_miui_name(miui_name))
+    return device.codename if device else None
+
+
+@tagged
+async def get_codename_from_miui_code(miui_code: str) -> Optional[str]:
+    device = await _scalar(queries.device_by_miui_code(miui_code))
+    return device.codename if device else None
+
+
+@tagged
+async def get_device_info(codename: str) -> Optional[Device]:
+    return await _scalar(queries.device_by_codename(codename))
+
+
+@tagged
+async def get_full_name(codename: str) -> Optional[str]:
+    device = await get_device_info(codename)
+    if not device or device.name is None or device.region is None:
+        return None
+    return f"{device.name} {device.region}"
+
+
+@tagged
+async def get_device_name(codename: str) -> Optional[str]:
+    device = await get_device_info(codename)
+    return device.name if device else None
+
+
+@tagged
+async def device_in_db(codename: str) -> bool:
+    return await get_device_info(codename) is not None
+
+
+@tagged
+async def get_incremental(version: str) -> Optional[Update]:
+    return await _scalar(queries.INCREMENTAL, {'version': version})
+
+
+@tagged
+async def get_version(codename: str, branch: str) -> Optional[str]:
+    return await _scalar(queries.version(codename, branch))
+
+
+@tagged
+async def get_update(filename: str) -> Optional[Update]:
+    return await _scalar(queries.UPDATE_BY_FILENAME, {'filename': filename})
+
+
+@tagged
+async def get_update_by_version(version: str, method: str = "Recovery") -> Optional[Update]:
+    return await _scalar(queries.UPDATE_BY_VERSION, {'version': version, 'method': method})
+
+
+@tagged
+async def update_in_db(filename: str) -> bool:
+    return await _scalar(queries.update_count(filename)) >= 1
+
+
+@tagged
+async def updates_not_in_db(filenames: Iterable[str], chunk_size: int = IN_CHUNK_SIZE) -> List[str]:
+    filenames = list(dict.fromkeys(filenames))
+    existing = set()
+    for chunk in chunked(filenames, chunk_size):
+        existing.update(await _scalars(queries.existing_filenames(chunk)))
+    return [filename for filename in filenames if filename not in existing]
+
+
+@tagged
+async def add_to_db(update: Union[Update, FirmwareUpdate, Device]):
+    """Adds an update to the database"""
+    async with _session() as session:
+        session.add(update)
+        await session.commit()
+    result_cache.invalidate()
+    if isinstance(update, Device):
+        device_registry.invalidate()
+
+
+@tagged
+async def get_firmware_current_devices() -> List[str]:
+    return await _scalars(queries.firmware_current_devices())
+
+
+@tagged
+async def firmware_update_in_db(codename: str, version: str) -> bool:
+    return await _scalar(queries.FIRMWARE_UPDATE_COUNT, {'codename': codename, 'version': version}) >= 1
+
+
+@tagged
+async def firmware_updates_not_in_db(updates: Iterable[Tuple[str, str]],
+                                     chunk_size: int = IN_CHUNK_SIZE) -> List[Tuple[str, str]]:
+    updates = list(dict.fromkeys((codename, version) for codename, version in updates))
+    existing = set()
+    for chunk in chunked(updates, chunk_size):
+        existing.update(tuple(row) for row in await _all(queries.firmware_existing_updates(chunk)))
+    return [update for update in updates if update not in existing]
+
+
+@tagged
+async def get_firmware_updates() -> List:
+    return await _all(queries.firmware_all_updates())
+
+
+@tagged
+async def get_firmware_updates_page(cursor: Optional[Cursor] = None, page_size: int = 1000) -> List:
+    return await _all(queries.firmware_updates_page(cursor, page_size))
+
+
+@tagged
+def iter_firmware_updates(page_size: int = 1000) -> AsyncIterator:
+    return _iter_keyset(lambda cursor: get_firmware_updates_page(cursor, page_size), page_size)
@@ -0,0 +1,220 @@
+"""
+Batched database writer
+"""
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Type, Union
+
+from sqlalchemy import bindparam, insert, select, update as update_statement
+from sqlalchemy.orm import Session
+
+from . import get_session
+from .cache import result_cache
+from .models import Base
+from .models.device import Device
+from .models.firmware_update import Update as FirmwareUpdate
+from .models.miui_update import Update as MiuiUpdate
+from .latest import KEY_ATTRIBUTES, latest_table_exists, refresh_latest
+from .registry import device_registry
+from .utils import IN_CHUNK_SIZE, chunked
+from .versions import version_key
+
+# Column used to tell whether a row is already in the database, for each model
+KEY_COLUMNS = {
+    MiuiUpdate: 'filename',
+    FirmwareUpdate: 'filename',
+    Device: 'codename',
+}
+# Other unique columns of each model: new rows with a value that is already taken are skipped
+UNIQUE_COLUMNS = {
+    MiuiUpdate: ('md5',),
+    FirmwareUpdate: ('md5',),
+    Device: (),
+}
+
+
+@dataclass
+class BulkStats:
+    """
+    Number of rows written by a BulkWriter
+    """
+    inserted: int = 0
+    updated: int = 0
+    skipped: int = 0
+
+    def __str__(self):
+        return f"inserted={self.inserted}, updated={self.updated}, skipped={self.skipped}"
+
+
+class BulkWriter:
+    """
+    Buffer rows of a model and write them in batches: new rows are inserted and existing rows
+    (by KEY_COLUMNS) are updated or skipped, with one executemany statement of each kind
+    and one commit per batch. Rows with a NULL key are always new. New rows that would conflict
+    on another unique column (UNIQUE_COLUMNS) are skipped, and the batch is rolled back if writing it fails.
+
+    with BulkWriter(Update, batch_size=1000) as writer:
+        for update in updates:
+            writer.add(update)
+    print(writer.stats)
+    """
+
+    def __init__(self, model: Type[Base], batch_size: int = 500, update_existing: bool = True,
+                 session: Optional[Session] = None):
+        """
+        :param model: Update (MIUI or firmware) or Device model
+        :param batch_size: number of buffered rows that triggers a flush
+        :param update_existing: update rows that are already in the database instead of skipping them
+        :param session: database session, the shared session by default
+        """
+        if model not in KEY_COLUMNS:
+            raise ValueError(f"Unsupported model {model.__name__}")
+        self.model = model
+        self.table = model.__table__
+        self.key = KEY_COLUMNS[model]
+        self.batch_size = batch_size
+        self.update_existing = update_existing
+        self.session = session
+        self.stats = BulkStats()
+        self._rows: List[dict] = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.flush()
+
+    def _to_dict(self, row: Union[Base, dict]) -> dict:
+        if isinstance(row, dict):
+            return row
+        # only keep attributes that were set, so that column defaults apply to the rest
+        return {column.key: getattr(row, column.key) for column in self.model.__mapper__.column_attrs
+                if column.key in row.__dict__}
+
+    def add(self, row: Union[Base, dict]):
+        """
+        Buffer a row, flushing the buffer when it reaches the batch size
+        :param row: model instance or dict of column values
+        """
+        row = self._to_dict(row)
+        if self.model is MiuiUpdate and 'version' in row and 'version_key' not in row:
+            # also set when updating existing rows, where the insert default doesn't apply
+            row = {**row, 'version_key': version_key(row['version'], row.get('android'))}
+        self._rows.append(row)
+        if len(self._rows) >= self.batch_size:
+            self.flush()
+
+    def add_all(self, rows: Iterable[Union[Base, dict]]):
+        """
+        Buffer many rows
+        :param rows: model instances or dicts of column values
+        """
+        for row in rows:
+            self.add(row)
+
+    def _existing_keys(self, session: Session, keys: List, column: Optional[str] = None) -> set:
+        key_column = self.table.c[column or self.key]
+        existing = set()
+        for chunk in chunked(keys, IN_CHUNK_SIZE):
+            existing.update(session.execute(select(key_column).where(key_column.in_(chunk))).scalars())
+        return existing
+
+    def _unique_rows(self, session: Session, new_rows: List[dict]) -> List[dict]:
+        """
+        Drop the new rows whose unique columns values are already in the database or in a previous row of the batch
+        """
+        for column in UNIQUE_COLUMNS[self.model]:
+            taken = self._existing_keys(session, list({row[column] for row in new_rows
+                                                       if row.get(column) is not None}), column)
+            unique_rows = []
+            for row in new_rows:
+                value = row.get(column)
+                if value is not None:
+                    if value in taken:
+                        continue
+                    taken.add(value)
+                unique_rows.append(row)
+            new_rows = unique_rows
+        return new_rows
+
+    def _latest_keys(self, session: Session, new_rows: List[dict], existing_rows: List[dict]) -> set:
+        """
+        Get the updates_latest keys affected by the rows, including the current keys of updated rows
+        """
+        if self.model is not MiuiUpdate or not latest_table_exists(session.connection()):
+            return set()
+        keys = {tuple(row.get(attribute) for attribute in KEY_ATTRIBUTES) for row in new_rows}
+        if self.update_existing:
+            keys.update(tuple(row.get(attribute) for attribute in KEY_ATTRIBUTES) for row in existing_rows
+                        if all(attribute in row for attribute in KEY_ATTRIBUTES))
+            for chunk in chunked([row[self.key] for row in existing_rows], IN_CHUNK_SIZE):
+                keys.update(tuple(key) for key in session.execute(
+                    select(MiuiUpdate.codename, MiuiUpdate.branch, MiuiUpdate.method).where(
+                        MiuiUpdate.filename.in_(chunk))))
+        return keys
+
+    def flush(self) -> BulkStats:
+        """
+        Write the buffered rows and commit
+        :return: stats of all rows written so far
+        """
+        if not self._rows:
+            return self.stats
+        session = self.session or get_session()
+        rows: Dict = {}
+        # rows without a key can't match existing or buffered rows: they are all new, only checked for conflicts
+        keyless_rows: List[dict] = []
+        duplicates = 0
+        for row in self._rows:
+            key = row.get(self.key)
+            if key is None:
+                keyless_rows.append(row)
+                continue
+            if key in rows:
+                duplicates += 1
+            rows[key] = row
+        self._rows = []
+        try:
+            existing = self._existing_keys(session, list(rows))
+            new_rows = [row for key, row in rows.items() if key not in existing] + keyless_rows
+            existing_rows = [row for key, row in rows.items() if key in existing]
+            unique_rows = self._unique_rows(session, new_rows)
+            conflicts = len(new_rows) - len(unique_rows)
+            new_rows = unique_rows
+            latest_keys = self._latest_keys(session, new_rows, existing_rows)
+            for group in _group_by_columns(new_rows):
+                session.execute(insert(self.table), group)
+            if self.update_existing:
+                statement = update_statement(self.table).where(self.table.c[self.key] == bindparam('_key'))
+                for group in _group_by_columns(existing_rows):
+                    params = [{**{column: value for column, value in row.items() if column not in ('id', self.key)},
+                               '_key': row[self.key]} for row in group]
+                    if len(params[0]) > 1:
+                        session.execute(statement, params)
+            if latest_keys:
+                refresh_latest(session.connection(), latest_keys)
+            session.commit()
+        except Exception:
+            # don't leave a partial batch in the session, to be committed by the next write
+            session.rollback()
+            raise
+        self.stats.inserted += len(new_rows)
+        if self.update_existing:
+            self.stats.updated += len(existing_rows)
+            self.stats.skipped += duplicates + conflicts
+        else:
+            self.stats.skipped += duplicates + conflicts + len(existing_rows)
+        result_cache.invalidate()
+        if self.model is Device:
+            device_registry.invalidate()
+        return self.stats
+
+
+def _group_by_columns(rows: List[dict]) -> List[List[dict]]:
+    """
+    Group rows that set the same columns, since an executemany statement needs the same parameters for all rows
+    """
+    groups: Dict[tuple, List[dict]] = {}
+    for row in rows:
+        groups.setdefault(tuple(sorted(row)), []).append(row)
+    return list(groups.values())
@@ -0,0 +1,116 @@
+"""
+Results cache of the expensive aggregate queries
+
+Cached results are kept until a write path of this package calls result_cache.invalidate(), or
+until a version probe (the newest update updated_on and the devices count) sees a change made by
+another process. The probe runs at most once per result_cache_probe_interval seconds (5 by default),
+so other processes' writes are seen after that delay at most. It reads with its own short-lived
+connection, so it sees new commits even when the thread session is in a REPEATABLE READ transaction.
+"""
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import wraps
+from threading import Lock
+from time import monotonic
+from typing import Callable, Optional
+
+from . import get_config, get_engine, queries
+
+# Seconds between version probes when result_cache_probe_interval is not set, 0 disables the probe
+DEFAULT_PROBE_INTERVAL = 5
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    invalidations: int = 0
+
+
+class ResultCache:
+    """
+    LRU cache of function results, keyed by function and arguments
+    """
+
+    def __init__(self, maxsize: Optional[int] = None, probe_interval: Optional[float] = None):
+        """
+        :param maxsize: maximum number of results, result_cache_size from config.yml by default (0 disables caching)
+        :param probe_interval: seconds between version probes, result_cache_probe_interval from config.yml
+        or DEFAULT_PROBE_INTERVAL by default (0 disables the probe)
+        """
+        self._maxsize = maxsize
+        self._probe_interval = probe_interval
+        self._lock = Lock()
+        self._results: OrderedDict = OrderedDict()
+        self._generation = 0
+        self._version = None
+        self._probed_at: Optional[float] = None
+        self.stats = CacheStats()
+
+    @property
+    def maxsize(self) -> int:
+        if self._maxsize is None:
+            self._maxsize = get_config().get('result_cache_size', 128)
+        return self._maxsize
+
+    @property
+    def probe_interval(self) -> Optional[float]:
+        if self._probe_interval is None:
+            interval = get_config().get('result_cache_probe_interval')
+            self._probe_interval = DEFAULT_PROBE_INTERVAL if interval is None else interval
+        return self._probe_interval
+
+    def invalidate(self):
+        """
+        Drop all cached results
+        """
+        with self._lock:
+            self._results.clear()
+            self._generation += 1
+            self.stats.invalidations += 1
+
+    def _probe(self):
+        if not self.probe_interval:
+            return
+        if self._probed_at is not None and monotonic() - self._probed_at < self.probe_interval:
+            return
+        self._probed_at = monotonic()
+        with get_engine().connect() as connection:
+            version = tuple(connection.execute(queries.cache_version()).one())
+        if version != self._version:
+            if self._version is not None:
+                self.invalidate()
+            self._version = version
+
+    def cached(self, function: Callable) -> Callable:
+        """
+        Decorator that caches the results of a function. Results are shared by all callers, lists are copied.
+        """
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not self.maxsize:
+                return function(*args, **kwargs)
+            self._probe()
+            key = (function.__qualname__, args, tuple(sorted(kwargs.items())))
+            with self._lock:
+                if key in self._results:
+                    self._results.move_to_end(key)
+                    self.stats.hits += 1
+                    return list(self._results[key])
+                self.stats.misses += 1
+                generation = self._generation
+            result = function(*args, **kwargs)
+            with self._lock:
+                # don't keep a result computed while the cache was invalidated
+                if generation == self._generation:
+                    self._results[key] = result
+                    if len(self._results) > self.maxsize:
+                        self._results.popitem(last=False)
+                        self.stats.evictions += 1
+            return list(result)
+
+        return wrapper
+
+
+result_cache = ResultCache()
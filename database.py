@@ -1,46 +1,64 @@
 """
 Database related functions
 """
-from typing import Optional, Union
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
-from sqlalchemy import or_
+from sqlalchemy import event, inspect
 from sqlalchemy.engine import result
-from sqlalchemy.sql.functions import concat, func
+from sqlalchemy.orm import make_transient_to_detached
 
-from . import session
+from . import get_config, get_session, queries, session_registry
+from .bulk import BulkStats, BulkWriter
+from .cache import result_cache
+from .feed import FEED_CHUNK_SIZE, iter_new, poll_new
+from .instrumentation import tagged
 from .models.device import Device
 from .models.miui_update import Update
+from .queries import LATEST_BRANCHES, Cursor, FeedCursor
+from .registry import device_registry
+from .rows import DeviceRow, UpdateRow, read_only_rows, row_statement, to_row
+from .search import device_index
+from .utils import IN_CHUNK_SIZE, chunked, iter_keyset
 
+# What happens to the objects of the session after add_to_db and commit_changes commits, see _commit()
+COMMIT_POLICIES = ('keep', 'expunge', 'remove')
 
+# Rows per keyset page of the archive listings
+PAGE_SIZE = 100
+
+
+@tagged
 def get_mi_website_ids() -> result:
     """
     SELECT mi_website_id as id, region FROM devices WHERE mi_website_id IS NOT NULL AND eol != 1 GROUP BY mi_website_id
     :return: list of tuples of (id, region)
     """
-    return session.query(Device.mi_website_id, Device.region).filter(Device.mi_website_id != None).filter(
-        Device.eol != 1).group_by(Device.mi_website_id)
+    return get_session().execute(queries.mi_website_ids())
 
 
+@tagged
+@result_cache.cached
 def get_fastboot_codenames() -> result:
     """
     SELECT codename, region FROM devices WHERE mi_website_id IS NOT NULL AND eol != 1 ORDER BY codename
     :return: list of codenames
     """
-    return session.query(Device.codename, Device.region).filter(Device.mi_website_id != None).filter(
-        Device.eol != 1).order_by(Device.codename).all()
+    return get_session().execute(queries.fastboot_codenames()).all()
 
 
+@tagged
+@result_cache.cached
 def get_current_devices() -> result:
     """
     SELECT codename from devices WHERE eol = 0 AND miui_code != "" AND (LENGTH(miui_code) = 4 or miui_code like '%RF' or miui_code like '%FK')
     :return: list of codenames
     """
-    return session.query(
-        Device.codename).filter(Device.eol == "0").filter(Device.miui_code != "").filter(
-        or_(func.length(Device.miui_code) == 4,
-            Device.miui_code.endswith("RF"), Device.miui_code.endswith("FK"))).all()
+    return get_session().execute(queries.current_devices()).all()
 
 
+@tagged
+@result_cache.cached
 def get_devices() -> result:
     """
     SELECT codename, CONCAT(name, ' ', region) as name, miui_name
@@ -50,118 +68,142 @@ def get_devices() -> result:
     GROUP BY codename
     ORDER BY codename
     """
-    return session.query(
-        Device.codename, concat(Device.name, ' ', Device.region).label('name'), Device.miui_name
-    ).filter(Device.miui_code != "").filter(or_(
-        func.length(Device.miui_code) == 4, Device.miui_code.endswith("RF"),
-        Device.miui_code.endswith("FK"))).order_by(Device.codename).all()
+    return get_session().execute(queries.devices()).all()
 
 
+@tagged
 def get_device_latest_version(codename) -> result:
     """
-    SELECT codename, version, android from updates WHERE codename = 'codename' AND updates.branch like "Stable%" AND updates.type = "Full" ORDER BY date DESC LIMIT 1
+    SELECT codename, version, android from updates WHERE codename = 'codename' AND updates.branch like "Stable%" AND updates.type = "Full" ORDER BY version_key DESC, date DESC, id DESC LIMIT 1
     :param codename: device codename
     :return: codename, version, android object
     """
-    return session.query(Update.codename, Update.version, Update.android).filter(Update.codename == codename).filter(
-        Update.branch.startswith("Stable")).filter(Update.type == "Full").order_by(Update.date.desc()).limit(1).first()
+    return get_session().execute(queries.DEVICE_LATEST_VERSION, {'codename': codename}).first()
+
+
+@tagged
+def get_devices_latest_version(codenames: Iterable[str]) -> Dict[str, result]:
+    """
+    Batch version of get_device_latest_version, in one query per IN_CHUNK_SIZE codenames
+    :param codenames: devices codenames
+    :return: dict of codename to codename, version, android object, without the codenames that have no update
+    """
+    session = get_session()
+    latest = {}
+    for chunk in chunked(set(codenames), IN_CHUNK_SIZE):
+        latest.update((row.codename, row) for row in session.execute(queries.devices_latest_version(chunk)))
+    return latest
 
 
+@tagged
+@result_cache.cached
 def get_latest_versions(branch: str = "Stable") -> result:
     """
-    SELECT latest.*
+    SELECT latest.codename, latest.version, latest.android
     FROM devices,
-     (
-         SELECT all_latest.*
-         FROM (SELECT codename, version, android
-               from updates
-               WHERE updates.branch like "Stable%"
-                 AND updates.type = "Full"
-               ORDER BY updates.date DESC
-               LIMIT 99999) as all_latest
-         GROUP BY all_latest.codename) as latest
-    WHERE latest.codename = devices.codename
+         (SELECT codename, version, android,
+                 ROW_NUMBER() OVER (PARTITION BY codename ORDER BY version_key DESC, date DESC, id DESC) AS row_number
+          FROM updates
+          WHERE updates.branch like "Stable%"
+            AND updates.type = "Full") as latest
+    WHERE latest.row_number = 1
+    AND latest.codename = devices.codename
     AND devices.eol = 0
     AND devices.miui_code != ""
     AND (LENGTH(miui_code) = 4 or miui_code like '%RF' or miui_code like '%FK')
     """
-    all_latest = session.query(Update.codename, Update.version, Update.android).filter(
-        Update.branch.startswith(branch)).filter(Update.type == "Full").order_by(Update.date.desc()).limit(
-        99999).subquery()
-    latest = session.query(all_latest).group_by(all_latest.c.codename).subquery()
-    updates = session.query(latest).filter(latest.c.codename == Device.codename).filter(
-        Device.eol == '0').filter(Device.miui_code != "").filter(
-        or_(func.length(Device.miui_code) == 4, Device.miui_code.endswith("RF"), Device.miui_code.endswith("FK"))).all()
-    return updates
+    return get_session().execute(queries.latest_versions(branch)).all()
 
 
+@tagged
 def get_latest_updates(branch: str = "Stable") -> result:
     """
-     SELECT CONCAT(devices.name, ' ', devices.region) as name, latest.*
+    SELECT devices.name, CONCAT(devices.name, ' ', devices.region) as fullname, latest.*
     FROM devices,
-     (
-         SELECT all_latest.*
-         FROM (SELECT codename, version, branch, method, size, md5, link, changelog, date
-               from updates
-               WHERE updates.branch = "Stable"
-                 AND updates.type = "Full"
-               ORDER BY updates.date DESC
-               LIMIT 99999) as all_latest
-         GROUP BY all_latest.codename, all_latest.method) as latest
-    WHERE latest.codename = devices.codename
+         (SELECT codename, version, android, branch, method, size, md5, link, changelog, date,
+                 ROW_NUMBER() OVER (PARTITION BY codename, method, branch
+                                    ORDER BY version_key DESC, date DESC, id DESC) AS row_number
+          FROM updates
+          WHERE updates.branch = "Stable"
+            AND updates.type = "Full") as latest
+    WHERE latest.row_number = 1
+    AND latest.codename = devices.codename
     AND devices.miui_code != ""
     AND (LENGTH(miui_code) = 4 or miui_code like '%RF' or miui_code like '%FK')
     ORDER BY date desc
     """
-    all_latest = session.query(
-        Update.codename, Update.version, Update.android, Update.branch,
-        Update.method, Update.size, Update.md5, Update.link, Update.changelog, Update.date).filter(
-        Update.branch == branch).filter(Update.type == "Full").order_by(Update.date.desc()).limit(99999).subquery()
-    latest = session.query(all_latest).group_by(all_latest.c.codename).group_by(all_latest.c.method).subquery()
-    updates = session.query(Device.name, concat(Device.name, ' ', Device.region).label('fullname'), latest).filter(
-        latest.c.codename == Device.codename).filter(Device.miui_code != "").filter(
-        or_(func.length(Device.miui_code) == 4, Device.miui_code.endswith("RF"),
-            Device.miui_code.endswith("FK"))).order_by(latest.c.date.desc()).all()
-    return updates
+    return get_session().execute(queries.latest_updates((branch,))).all()
 
 
-def get_all_latest_updates():
-    return get_latest_updates(branch="Stable Beta") + get_latest_updates() + get_latest_updates(
-        branch="Weekly") + get_latest_updates("Public Beta")
+@tagged
+@result_cache.cached
+def get_all_latest_updates() -> result:
+    """
+    Get the latest updates of Stable Beta, Stable, Weekly and Public Beta branches in one query,
+    in that order of branches.
+    """
+    return get_session().execute(queries.latest_updates(LATEST_BRANCHES)).all()
+
+
+@tagged
+def iter_new_updates(since: Union[datetime, FeedCursor], chunk_size: int = FEED_CHUNK_SIZE) -> Iterator[UpdateRow]:
+    """
+    Iterate over the updates inserted since a date or after a (inserted_on, id) cursor, in insertion order.
+    Resume later from feed.cursor_of() the last update, or wait for new ones with poll_new_updates.
+    """
+    return iter_new(Update, since, chunk_size)
+
+
+@tagged
+def poll_new_updates(since: Union[datetime, FeedCursor], timeout: Optional[float] = None,
+                     max_interval: float = 60) -> Tuple[List[UpdateRow], FeedCursor]:
+    """
+    Wait for updates inserted after a cursor, see feed.poll_new
+    :return: new updates (empty after a timeout) and the cursor to poll from next
+    """
+    return poll_new(Update, since, timeout=timeout, max_interval=max_interval)
 
 
+@tagged
 def get_device_latest(codename) -> result:
     """
     SELECT CONCAT(devices.name, ' ', devices.region) as name, latest.*
     FROM devices,
-         (
-             SELECT all_latest.*
-             FROM (SELECT codename, version, android, branch, method, filename, size, md5, link, changelog, date
-                   from updates
-                   WHERE codename like 'whyred%'
-                     AND (updates.branch like "Stable%" OR updates.branch = "Weekly" OR updates.branch = "Public Beta")
-                     AND updates.type = "Full"
-                   ORDER BY updates.date DESC
-                   LIMIT 99999) as all_latest
-             GROUP BY all_latest.codename, all_latest.method, all_latest.branch) as latest
-    WHERE devices.codename = latest.codename
+         (SELECT codename, version, android, branch, method, filename, size, md5, link, changelog, date,
+                 ROW_NUMBER() OVER (PARTITION BY codename, method, branch
+                                    ORDER BY version_key DESC, date DESC, id DESC) AS row_number
+          FROM updates
+          WHERE codename like 'whyred%'
+            AND (updates.branch like "Stable%" OR updates.branch = "Weekly" OR updates.branch = "Public Beta")
+            AND updates.type = "Full") as latest
+    WHERE latest.row_number = 1
+      AND devices.codename = latest.codename
       AND (LENGTH(miui_code) = 4 or miui_code like '%RF' or miui_code like '%FK')
     """
-    all_latest = session.query(
-        Update.codename, Update.version, Update.android, Update.branch,
-        Update.method, Update.filename, Update.size, Update.md5, Update.link, Update.changelog, Update.date).filter(
-        Update.codename.startswith(codename)).filter(
-        or_(Update.branch.startswith("Stable"), Update.branch == "Weekly", Update.branch == "Public Beta")).filter(
-        Update.type == "Full").order_by(Update.date.desc()).limit(99999).subquery()
-    latest = session.query(all_latest).group_by(all_latest.c.codename).group_by(
-        all_latest.c.method).group_by(all_latest.c.branch).subquery()
-    updates = session.query(concat(Device.name, ' ', Device.region).label('name'), latest).filter(
-        Device.codename == latest.c.codename).filter(
-        or_(func.length(Device.miui_code) == 4, Device.miui_code.endswith("RF"),
-            Device.miui_code.endswith("FK"))).all()
-    return updates
+    return get_session().execute(queries.device_latest(codename)).all()
+
+
+@tagged
+def get_devices_latest(codenames: Iterable[str], chunk_size: int = 100) -> Dict[str, List]:
+    """
+    Batch version of get_device_latest, in one query per chunk_size codenames.
+    Like get_device_latest, each codename also gets the rows of the codenames it prefixes (region variants).
+    :param codenames: devices codenames
+    :param chunk_size: codenames per query, each one adds a LIKE condition
+    :return: dict of codename to the list of get_device_latest rows, empty for codenames without updates
+    """
+    session = get_session()
+    codenames = set(codenames)
+    latest = {codename: [] for codename in codenames}
+    for chunk in chunked(sorted(codenames), chunk_size):
+        for row in session.execute(queries.devices_latest(chunk)):
+            for codename in chunk:
+                if row.codename.startswith(codename):
+                    latest[codename].append(row)
+    return latest
 
 
+@tagged
 def get_device_roms(codename) -> result:
     """
     SELECT CONCAT(devices.name, ' ', devices.region) as name, all_updates.*
@@ -177,55 +219,137 @@ def get_device_roms(codename) -> result:
     WHERE devices.codename = all_updates.codename
       AND (LENGTH(miui_code) = 4 or miui_code like '%RF' or miui_code like '%FK')
     """
-    all_updates = session.query(
-        Update.codename, Update.version, Update.android, Update.branch, Update.method, Update.filename, Update.size,
-        Update.md5, Update.link, Update.changelog, Update.date).filter(
-        Update.codename.startswith(codename)).filter(
-        or_(Update.branch.startswith("Stable"), Update.branch == "Weekly", Update.branch == "Public Beta")).filter(
-        Update.type == "Full").order_by(Update.date.desc()).limit(99999).subquery()
-    updates = session.query(concat(Device.name, ' ', Device.region).label('name'), all_updates).filter(
-        Device.codename == all_updates.c.codename).filter(
-        or_(func.length(Device.miui_code) == 4, Device.miui_code.endswith("RF"),
-            Device.miui_code.endswith("FK"))).all()
-    return updates
+    return get_session().execute(queries.device_roms(codename)).all()
+
+
+@tagged
+def get_device_roms_page(codename: str, cursor: Optional[Cursor] = None, page_size: int = PAGE_SIZE) -> List:
+    """
+    Page of get_device_roms rows, newest first. Rows also have the update id, pass (row.date, row.id)
+    of the last row as the cursor of the next page: every page costs the same as the first one.
+    :param codename: device codename
+    :param cursor: (date, id) of the last row of the previous page, None for the first page
+    :param page_size: maximum number of rows
+    :return: list of rows, shorter than page_size on the last page
+    """
+    return get_session().execute(queries.device_roms_page(codename, cursor, page_size)).all()
+
+
+@tagged
+def iter_device_roms(codename: str, page_size: int = PAGE_SIZE) -> Iterator:
+    """
+    Stream get_device_roms_page rows of all pages
+    """
+    return iter_keyset(lambda cursor: get_device_roms_page(codename, cursor, page_size), page_size)
 
 
+@tagged
 def get_codename(miui_name: str) -> result:
     if miui_name.endswith("PRE"):
         miui_name = miui_name.replace("PRE", "")
-    codename = session.query(Device).filter(Device.miui_name == miui_name).first()
-    return codename.codename if codename else None
+    device = device_registry.get_by_miui_name(miui_name)
+    return device.codename if device else None
 
 
+@tagged
 def get_codename_from_miui_code(miui_code) -> result:
-    codename = session.query(Device).filter(Device.miui_code == miui_code).first()
-    return codename.codename if codename else None
+    device = device_registry.get_by_miui_code(miui_code)
+    return device.codename if device else None
 
 
+@tagged
 def get_full_name(codename: str) -> Optional[str]:
-    full_name = session.query(concat(Device.name, ' ', Device.region)).filter(Device.codename == codename).first()
-    return full_name[0] if full_name else None
+    device = device_registry.get(codename)
+    # CONCAT(name, ' ', region) is NULL if any of them is NULL
+    if not device or device.name is None or device.region is None:
+        return None
+    return f"{device.name} {device.region}"
 
 
+@tagged
 def get_device_name(codename: str) -> Optional[str]:
-    name = session.query(Device.name).filter(Device.codename == codename).first()
-    return name[0] if name else None
+    device = device_registry.get(codename)
+    return device.name if device else None
 
 
-def get_device_info(codename: str) -> result:
-    return session.query(Device).filter(Device.codename == codename).first()
+def _device_copies(devices: List[Device]) -> List[Union[Device, DeviceRow]]:
+    """
+    Copies of registry devices for a caller, built without a query: read-only rows when read_only_rows is set,
+    detached Device objects otherwise, which commit_changes and add_to_db save when they are changed.
+    The shared registry objects are never modified.
+    """
+    if read_only_rows():
+        return [to_row(device, Device) for device in devices]
+    copies = []
+    class_manager = inspect(Device).class_manager
+    for device in devices:
+        # filled like the ORM loads objects, without the attribute events of the constructor
+        copy = class_manager.new_instance()
+        copy.__dict__.update({attribute.key: getattr(device, attribute.key)
+                              for attribute in Device.__mapper__.column_attrs})
+        make_transient_to_detached(copy)
+        copies.append(copy)
+    return copies
+
+
+def _track_device_change(target: Device, value, oldvalue, initiator):
+    # remember the changed detached devices (copies from _device_copies), so that commit_changes saves them
+    if inspect(target).detached:
+        get_session().info.setdefault('changed_devices', []).append(target)
+
+
+for _attribute in Device.__mapper__.column_attrs:
+    event.listen(getattr(Device, _attribute.key), 'set', _track_device_change)
+
+
+def _attach(session, item: Union[Update, Device]):
+    """
+    Add a detached object back to the session, so that its changes are saved, or copy its state
+    to the object of the session that has the same identity
+    """
+    if inspect(item).key in session.identity_map:
+        session.merge(item)
+    else:
+        session.add(item)
+
+
+@tagged
+def get_device_info(codename: str) -> Union[Device, DeviceRow, None]:
+    device = device_registry.get(codename)
+    return _device_copies([device])[0] if device is not None else None
+
+
+@tagged
+def search_devices(query: str, limit: int = 10) -> List[Union[Device, DeviceRow]]:
+    """
+    Search devices by codename, name, MIUI name or MIUI code prefix, or fuzzy match, best matches first
+    :param query: search text, e.g. "whyr", "redmi note 5", "WHYREDGlobal"
+    :param limit: maximum number of devices
+    :return: list of devices
+    """
+    return _device_copies(device_index.search(query, limit))
+
+
+def _first_update(statement, parameters: Optional[dict] = None) -> Union[Update, UpdateRow, None]:
+    """
+    First update of a statement, as a read-only row when read_only_rows is set, as an Update object otherwise
+    """
+    if read_only_rows():
+        return to_row(get_session().execute(row_statement(statement, Update), parameters).first(), Update)
+    return get_session().execute(statement, parameters).scalars().first()
 
 
-def get_incremental(version: str) -> Update:
+@tagged
+def get_incremental(version: str) -> Union[Update, UpdateRow, None]:
     """
     Get incremental update information of a version
     :type version: str
     :param version: Xiaomi software version
     """
-    return session.query(Update).filter(
-        Update.version == version).filter(Update.type == "Incremental").first()
+    return _first_update(queries.INCREMENTAL, {'version': version})
 
 
+@tagged
 def get_version(codename: str, branch: str) -> str:
     """
     Get device version example
@@ -233,76 +357,159 @@ def get_version(codename: str, branch: str) -> str:
     :type codename: str
     :param branch: Update branch
     """
-    query = session.query(Update).filter(Update.codename == codename).filter(Update.branch == branch).first()
-    return query.version if query else None
-
-
+    return get_session().execute(queries.version(codename, branch)).scalar()
+
+
+def _commit(session):
+    """
+    Commit the session, then apply session_commit_policy from config.yml:
+    keep the committed objects in the session (keep, the default), detach them (expunge),
+    or close the thread session so that the next call starts a new one (remove).
+    Objects are not expired by the commit of the expunge and remove policies, and their server generated
+    values are loaded before they are detached, so callers can still read them.
+    """
+    policy = get_config().get('session_commit_policy') or 'keep'
+    if policy not in COMMIT_POLICIES:
+        raise ValueError(f"Unknown session_commit_policy {policy}, expected one of {', '.join(COMMIT_POLICIES)}")
+    if policy == 'keep':
+        session.commit()
+        return
+    expire_on_commit = session.expire_on_commit
+    session.expire_on_commit = False
+    try:
+        session.commit()
+    finally:
+        session.expire_on_commit = expire_on_commit
+    for item in list(session.identity_map.values()):
+        expired = inspect(item).expired_attributes
+        if expired:
+            # e.g. inserted_on, set by the database during the flush
+            session.refresh(item, attribute_names=list(expired))
+    if policy == 'expunge':
+        session.expunge_all()
+        # end the transaction of the refreshes, nothing is left in the session to expire
+        session.rollback()
+    else:
+        session_registry.remove()
+
+
+@tagged
 def add_to_db(update: Union[Update, Device], exists=False):
     """Adds an update to the database"""
+    session = get_session()
     if not exists:
         session.add(update)
-    session.commit()
-
-
+    elif inspect(update).detached:
+        # e.g. detached by a commit policy, or a device copy: added back so that its changes are saved
+        _attach(session, update)
+    _commit(session)
+    result_cache.invalidate()
+    if isinstance(update, Device):
+        device_registry.invalidate()
+
+
+@tagged
+def add_all_to_db(updates: Iterable[Union[Update, Device]], batch_size: int = 500,
+                  update_existing: bool = True) -> BulkStats:
+    """
+    Adds many updates or devices to the database, committing once per batch
+    :param updates: Update or Device objects, all of the same model
+    :param batch_size: number of rows written per transaction
+    :param update_existing: update rows that are already in the database instead of skipping them
+    :return: number of inserted, updated and skipped rows
+    """
+    writer = None
+    for item in updates:
+        if writer is None:
+            writer = BulkWriter(type(item), batch_size=batch_size, update_existing=update_existing)
+        writer.add(item)
+    return writer.flush() if writer else BulkStats()
+
+
+@tagged
 def update_in_db(filename) -> bool:
     """
     Check if an update is already in the database
     :param filename: Update file name
     :return: True if the update is already in the database
     """
-    return bool(session.query(Update).filter_by(filename=filename).count() >= 1)
+    return get_session().execute(queries.update_count(filename)).scalar() >= 1
 
 
-def device_in_db(codename) -> bool:
+@tagged
+def updates_not_in_db(filenames: Iterable[str], chunk_size: int = IN_CHUNK_SIZE) -> List[str]:
     """
-    Check if a device is already in the database
-    :param codename: Device codename
-    :return: True if the device is already in the database
+    Check which updates are not in the database yet, using one query per chunk of filenames
+    :param filenames: Update file names
+    :param chunk_size: number of filenames per IN query
+    :return: list of the new filenames, in their original order without duplicates
     """
-    return bool(session.query(Device).filter_by(codename=codename).first())
+    filenames = list(dict.fromkeys(filenames))
+    session = get_session()
+    existing = set()
+    for chunk in chunked(filenames, chunk_size):
+        existing.update(session.execute(queries.existing_filenames(chunk)).scalars())
+    return [filename for filename in filenames if filename not in existing]
 
 
-def get_update(filename) -> Update:
+@tagged
+def get_update(filename) -> Union[Update, UpdateRow, None]:
     """
     Get an update from the database
     :param filename: update filename
     :return: update object
     """
-    return session.query(Update).filter(Update.filename == filename).first()
+    return _first_update(queries.UPDATE_BY_FILENAME, {'filename': filename})
 
 
-def get_update_by_version(version, method: str = "Recovery") -> Update:
+@tagged
+def get_update_by_version(version, method: str = "Recovery") -> Union[Update, UpdateRow, None]:
     """
     Get a recovery update from the database
     :param method: Recovery/Fastboot
     :param version: update version
     :return: update object
     """
-    return session.query(Update).filter(Update.version == version).filter(
-        Update.method == method).filter(Update.type == "Full").first()
+    return _first_update(queries.UPDATE_BY_VERSION, {'version': version, 'method': method})
 
 
+@tagged
 def device_in_db(codename) -> bool:
     """
     Check if a device is already in the database
     :param codename: Device codename
-    :return: True if the update is already in the database
+    :return: True if the device is already in the database
     """
-    return bool(session.query(Device).filter_by(codename=codename).count() >= 1)
+    return codename in device_registry
 
 
-def update_stable_beta(recovery_update: Update):
+@tagged
+def update_stable_beta(recovery_update: Union[Update, UpdateRow]):
     """
-    recovery_update: Update object
+    recovery_update: Update object or read-only row
     """
     if recovery_update:
         if recovery_update.branch == "Stable Beta":
+            if isinstance(recovery_update, UpdateRow):
+                recovery_update = get_session().get(Update, recovery_update.id)
+            elif inspect(recovery_update).detached:
+                # detached by the expunge or remove session_commit_policy
+                _attach(get_session(), recovery_update)
             recovery_update.branch = "Stable"
             commit_changes()
 
 
+@tagged
 def commit_changes():
     """
     commit database changes
     """
-    session.commit()
+    session = get_session()
+    for device in session.info.pop('changed_devices', []):
+        if inspect(device).detached:
+            _attach(session, device)
+    devices_changed = any(isinstance(item, Device) for item in (*session.new, *session.dirty, *session.deleted))
+    _commit(session)
+    result_cache.invalidate()
+    if devices_changed:
+        device_registry.invalidate()
@@ -0,0 +1,101 @@
+"""
+Change feed of the updates and firmware tables
+
+Rows are read in (inserted_on, id) order after a cursor, the (inserted_on, id) of the last row read,
+so a consumer only reads the rows inserted since its previous run:
+
+    cursor = (datetime(2024, 1, 1), 0)
+    while True:
+        updates, cursor = poll_new(Update, cursor)
+        notify(updates)
+        save(cursor)
+
+Each page is read with its own short-lived connection, so that new rows are seen even with
+REPEATABLE READ transactions, without touching the shared session. inserted_on is set when a row
+is inserted, so a row committed by a long transaction after newer rows were read can be skipped:
+writers should keep their transactions short.
+"""
+from datetime import datetime
+from time import monotonic, sleep
+from typing import Iterator, List, Optional, Tuple, Type, Union
+
+from . import get_engine, queries
+from .models.firmware_update import Update as FirmwareUpdate
+from .models.miui_update import Update
+from .queries import FeedCursor
+from .rows import FirmwareRow, UpdateRow, to_row
+
+FEED_CHUNK_SIZE = 500
+FeedRow = Union[UpdateRow, FirmwareRow]
+
+
+def feed_cursor(since: Union[datetime, FeedCursor]) -> FeedCursor:
+    """
+    Get the cursor of a date (all rows inserted since then) or of a (inserted_on, id) tuple
+    """
+    return (since, 0) if isinstance(since, datetime) else tuple(since)
+
+
+def cursor_of(row: FeedRow) -> FeedCursor:
+    """
+    Get the cursor that resumes the feed after a row
+    """
+    return row.inserted_on, row.id
+
+
+def fetch_new(model: Type[Union[Update, FirmwareUpdate]], since: Union[datetime, FeedCursor],
+              limit: int = FEED_CHUNK_SIZE) -> List[FeedRow]:
+    """
+    Get a page of rows inserted after a cursor
+    :param model: MIUI or firmware Update model
+    :param since: cursor, or date of the first rows to read
+    :param limit: maximum number of rows
+    :return: read-only rows, in (inserted_on, id) order
+    """
+    with get_engine().connect() as connection:
+        return [to_row(row, model) for row in connection.execute(
+            queries.inserted_after(model, feed_cursor(since), limit))]
+
+
+def iter_new(model: Type[Union[Update, FirmwareUpdate]], since: Union[datetime, FeedCursor],
+             chunk_size: int = FEED_CHUNK_SIZE) -> Iterator[FeedRow]:
+    """
+    Iterate over all rows inserted after a cursor, chunk_size rows at a time.
+    Resume later from cursor_of() the last row.
+    """
+    cursor = feed_cursor(since)
+    while True:
+        rows = fetch_new(model, cursor, chunk_size)
+        yield from rows
+        if len(rows) < chunk_size:
+            return
+        cursor = cursor_of(rows[-1])
+
+
+def poll_new(model: Type[Union[Update, FirmwareUpdate]], since: Union[datetime, FeedCursor],
+             timeout: Optional[float] = None, min_interval: float = 1, max_interval: float = 60,
+             limit: int = FEED_CHUNK_SIZE) -> Tuple[List[FeedRow], FeedCursor]:
+    """
+    Wait for rows inserted after a cursor, polling with an exponential backoff
+    :param model: MIUI or firmware Update model
+    :param since: cursor, or date of the first rows to read
+    :param timeout: seconds to wait at most, forever if None
+    :param min_interval: seconds before the second poll, doubled after each empty poll
+    :param max_interval: maximum seconds between polls
+    :param limit: maximum number of rows returned
+    :return: new rows (empty after a timeout) and the cursor to poll from next
+    """
+    cursor = feed_cursor(since)
+    deadline = monotonic() + timeout if timeout is not None else None
+    interval = min_interval
+    while True:
+        rows = fetch_new(model, cursor, limit)
+        if rows:
+            return rows, cursor_of(rows[-1])
+        delay = interval
+        if deadline is not None:
+            if monotonic() >= deadline:
+                return [], cursor
+            delay = max(min(delay, deadline - monotonic()), 0)
+        sleep(delay)
+        interval = min(interval * 2, max_interval)
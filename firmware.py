@@ -1,25 +1,33 @@
 """
 Database Firmware Updates related functions
 """
-from typing import List
+from datetime import datetime
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
 
 from sqlalchemy.engine import result
-from sqlalchemy.sql.functions import concat
 
-from . import session
-from .models.device import Device
+from . import get_session, queries
+from .feed import FEED_CHUNK_SIZE, iter_new, poll_new
+from .instrumentation import tagged
 from .models.firmware_update import Update
+from .queries import Cursor, FeedCursor
+from .rows import FirmwareRow
+from .utils import IN_CHUNK_SIZE, chunked, iter_keyset
 
+# Rows per keyset page of the archive listings
+PAGE_SIZE = 1000
 
+
+@tagged
 def get_current_devices() -> List[str]:
     """
     SELECT codename FROM devices WHERE firmware_updater IS TRUE ORDER BY codename
     :return: list of codename strings
     """
-    return [i.codename for i in
-            session.query(Device.codename).filter(Device.firmware_updater == 1).order_by(Device.codename)]
+    return list(get_session().execute(queries.firmware_current_devices()).scalars())
 
 
+@tagged
 def update_in_db(codename, version) -> bool:
     """
     Check if an update is already in the database
@@ -27,9 +35,27 @@ def update_in_db(codename, version) -> bool:
     :param version: Update version
     :return: True if the update is already in the database
     """
-    return bool(session.query(Update).filter_by(codename=codename).filter_by(version=version).count() >= 1)
+    parameters = {'codename': codename, 'version': version}
+    return get_session().execute(queries.FIRMWARE_UPDATE_COUNT, parameters).scalar() >= 1
+
 
+@tagged
+def updates_not_in_db(updates: Iterable[Tuple[str, str]], chunk_size: int = IN_CHUNK_SIZE) -> List[Tuple[str, str]]:
+    """
+    Check which updates are not in the database yet, using one query per chunk of updates
+    :param updates: (codename, version) pairs
+    :param chunk_size: number of pairs per IN query
+    :return: list of the new (codename, version) pairs, in their original order without duplicates
+    """
+    updates = list(dict.fromkeys((codename, version) for codename, version in updates))
+    session = get_session()
+    existing = set()
+    for chunk in chunked(updates, chunk_size):
+        existing.update(tuple(row) for row in session.execute(queries.firmware_existing_updates(chunk)))
+    return [update for update in updates if update not in existing]
 
+
+@tagged
 def get_all_updates() -> result:
     """
     SELECT CONCAT(d.name, ' ', d.region) as name, firmware.codename, version,
@@ -39,7 +65,52 @@ def get_all_updates() -> result:
     GROUP BY md5
     :return: list of firmware results
     """
-    return session.query(
-        concat(Device.name, ' ', Device.region).label('name'), Update.codename, Update.version,
-        Update.android, Update.branch, Update.filename, Update.size, Update.md5, Update.date
-    ).join(Device, Update.codename == Device.codename).group_by(Update.md5).all()
+    return get_session().execute(queries.firmware_all_updates()).all()
+
+
+@tagged
+def get_updates_page(cursor: Optional[Cursor] = None, page_size: int = PAGE_SIZE) -> List:
+    """
+    Page of get_all_updates rows, newest first. Rows also have the update id, pass (row.date, row.id)
+    of the last row as the cursor of the next page: every page costs the same as the first one.
+    :param cursor: (date, id) of the last row of the previous page, None for the first page
+    :param page_size: maximum number of rows
+    :return: list of rows, shorter than page_size on the last page
+    """
+    return get_session().execute(queries.firmware_updates_page(cursor, page_size)).all()
+
+
+@tagged
+def iter_all_updates(page_size: int = PAGE_SIZE) -> Iterator:
+    """
+    Stream get_updates_page rows of all pages, keeping only one page in memory
+    """
+    return iter_keyset(lambda cursor: get_updates_page(cursor, page_size), page_size)
+
+
+@tagged
+def get_updates_since(since: datetime) -> result:
+    """
+    Same as get_all_updates, only for updates inserted since a date
+    :param since: inserted_on watermark
+    :return: list of firmware results
+    """
+    return get_session().execute(queries.firmware_updates_since(since)).all()
+
+
+@tagged
+def iter_new_updates(since: Union[datetime, FeedCursor], chunk_size: int = FEED_CHUNK_SIZE) -> Iterator[FirmwareRow]:
+    """
+    Iterate over the firmware updates inserted since a date or after a (inserted_on, id) cursor, in insertion order
+    """
+    return iter_new(Update, since, chunk_size)
+
+
+@tagged
+def poll_new_updates(since: Union[datetime, FeedCursor], timeout: Optional[float] = None,
+                     max_interval: float = 60) -> Tuple[List[FirmwareRow], FeedCursor]:
+    """
+    Wait for firmware updates inserted after a cursor, see feed.poll_new
+    :return: new updates (empty after a timeout) and the cursor to poll from next
+    """
+    return poll_new(Update, since, timeout=timeout, max_interval=max_interval)
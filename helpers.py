@@ -1,41 +1,261 @@
 """
 Database helper functions
 """
+import json
+import os
+from datetime import datetime
+from pathlib import Path
+from typing import IO, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import yaml
 from humanize import naturalsize
 
-from .database import get_all_latest_updates, get_devices
+from . import get_session, queries
+from .firmware import iter_all_updates
+from .instrumentation import tagged
+from .models.firmware_update import Update as FirmwareUpdate
+from .queries import LATEST_BRANCHES, CodenameRange
+
+# Rows fetched per round trip by the streaming exporters
+EXPORT_CHUNK_SIZE = 1000
 
 
 def safe_naturalsize(size):
     return naturalsize(size) if size is not None else 'Unknown'
 
 
+def _latest_item(item) -> dict:
+    return {
+        "android": item.android,
+        "branch": item.branch,
+        "codename": item.codename,
+        "date": item.date,
+        "name": item.fullname,
+        "md5": item.md5,
+        "method": item.method,
+        "link": item.link,
+        "size": safe_naturalsize(item.size),
+        "version": item.version,
+    }
+
+
+@tagged
+def iter_latest(chunk_size: int = EXPORT_CHUNK_SIZE, branches: Tuple[str, ...] = LATEST_BRANCHES,
+                codename_range: Optional[CodenameRange] = None) -> Iterator[dict]:
+    """
+    Stream the latest updates ordered by codename, fetching chunk_size rows at a time
+    :param branches: exported branches, in their export order
+    :param codename_range: only the codenames of a [first, end) range
+    :return: iterator of exported updates dicts
+    """
+    statement = queries.latest_updates(branches, by_codename=True, codename_range=codename_range).execution_options(
+        yield_per=chunk_size)
+    for item in get_session().execute(statement):
+        yield _latest_item(item)
+
+
+@tagged
+def iter_devices(chunk_size: int = EXPORT_CHUNK_SIZE,
+                 codename_range: Optional[CodenameRange] = None) -> Iterator[Tuple[str, List[str]]]:
+    """
+    Stream the devices ordered by codename, fetching chunk_size rows at a time
+    :param codename_range: only the codenames of a [first, end) range
+    :return: iterator of (codename, [name, miui_name]) tuples
+    """
+    statement = queries.devices(codename_range).execution_options(yield_per=chunk_size)
+    previous = None
+    # a codename can have more than one row, keep the last one like a dict would
+    for device in get_session().execute(statement):
+        if previous is not None and previous.codename != device.codename:
+            yield previous.codename, [previous.name, previous.miui_name]
+        previous = device
+    if previous is not None:
+        yield previous.codename, [previous.name, previous.miui_name]
+
+
+def list_fragment(item: dict, fmt: str) -> str:
+    return json.dumps(item, default=str) if fmt == 'json' else yaml.dump([item], allow_unicode=True)
+
+
+def dict_fragment(key: str, value, fmt: str) -> str:
+    if fmt == 'json':
+        return f"{json.dumps(key)}: {json.dumps(value, default=str)}"
+    return yaml.dump({key: value}, allow_unicode=True)
+
+
+def write_fragments(fragments: Iterable[str], fp: IO[str], fmt: str, brackets: str):
+    """
+    Write serialized list items or dict entries: YAML fragments are concatenated, JSON ones are joined
+    with commas between brackets
+    """
+    if fmt == 'json':
+        fp.write(brackets[0])
+        for index, fragment in enumerate(fragments):
+            fp.write(f"{',' if index else ''}\n{fragment}")
+        fp.write(f'\n{brackets[1]}\n')
+    elif fmt == 'yaml':
+        for fragment in fragments:
+            fp.write(fragment)
+    else:
+        raise ValueError(f"Unknown export format {fmt}")
+
+
+def _write_list(items: Iterator[dict], fp: IO[str], fmt: str):
+    write_fragments((list_fragment(item, fmt) for item in items), fp, fmt, '[]')
+
+
+def _write_dict(items: Iterator[Tuple[str, object]], fp: IO[str], fmt: str):
+    write_fragments((dict_fragment(key, value, fmt) for key, value in items), fp, fmt, '{}')
+
+
+@tagged
+def write_latest(fp: IO[str], fmt: str = 'yaml', chunk_size: int = EXPORT_CHUNK_SIZE):
+    """
+    Write the latest updates to a file object as they are read from the database
+    :param fp: text file object
+    :param fmt: yaml or json
+    :param chunk_size: rows fetched per round trip
+    """
+    _write_list(iter_latest(chunk_size), fp, fmt)
+
+
+@tagged
+def write_devices(fp: IO[str], fmt: str = 'yaml', chunk_size: int = EXPORT_CHUNK_SIZE):
+    """
+    Write the devices to a file object as they are read from the database
+    :param fp: text file object
+    :param fmt: yaml or json
+    :param chunk_size: rows fetched per round trip
+    """
+    _write_dict(iter_devices(chunk_size), fp, fmt)
+
+
+@tagged
 def export_latest():
     """
     Export latest updates from the database to YAML file
     :return:
     """
-    latest_updates = get_all_latest_updates()
-    return sorted(
-        [
-            {
-                "android": item.android,
-                "branch": item.branch,
-                "codename": item.codename,
-                "date": item.date,
-                "name": item.fullname,
-                "md5": item.md5,
-                "method": item.method,
-                "link": item.link,
-                "size": safe_naturalsize(item.size),
-                "version": item.version,
-            }
-            for item in latest_updates
-        ],
-        key=lambda x: x["codename"],
-    )
+    return list(iter_latest())
 
 
+@tagged
 def export_devices():
-    devices = get_devices()
-    return {device.codename: [device.name, device.miui_name] for device in devices}
+    return dict(iter_devices())
+
+
+def _firmware_item(item) -> dict:
+    return {
+        "android": item.android,
+        "branch": item.branch,
+        "codename": item.codename,
+        "date": item.date,
+        "filename": item.filename,
+        "md5": item.md5,
+        "name": item.name,
+        "size": safe_naturalsize(item.size),
+        "version": item.version,
+    }
+
+
+def _watermark_file(path: Path) -> Path:
+    return path.with_name(f"{path.name}.watermark")
+
+
+def _read_watermark(path: Path) -> Optional[datetime]:
+    watermark_file = _watermark_file(path)
+    if not path.exists() or not watermark_file.exists():
+        return None
+    return datetime.fromisoformat(watermark_file.read_text().strip())
+
+
+def _load_export(path: Path, fmt: str):
+    with open(path, 'r') as f:
+        return json.load(f) if fmt == 'json' else yaml.safe_load(f)
+
+
+def _save_export(path: Path, items: Iterable[dict], fmt: str, watermark: Optional[datetime]):
+    # write to a temporary file first, so that readers never see a partial export
+    temporary_file = path.with_name(f"{path.name}.tmp")
+    with open(temporary_file, 'w') as f:
+        _write_list(iter(items), f, fmt)
+    os.replace(temporary_file, path)
+    if watermark is not None:
+        _watermark_file(path).write_text(watermark.isoformat())
+
+
+@tagged
+def export_latest_delta(path: Union[str, Path], fmt: str = 'yaml') -> int:
+    """
+    Update a latest updates export file with the updates inserted or changed since it was last written.
+    The updated_on watermark is kept next to the file (<file>.watermark). Only the devices that got
+    new or changed updates are queried again and replaced, the other entries are kept from the previous
+    export. Without a previous export, a full export is written. Deleted updates are not tracked:
+    remove the watermark file to force a full export after deleting updates.
+    :param path: export file path
+    :param fmt: yaml or json
+    :return: number of devices that changed, -1 for a full export
+    """
+    path = Path(path)
+    session = get_session()
+    # read the new watermark first, rows written meanwhile will be read again next time
+    watermark = session.execute(queries.max_updated_on()).scalar()
+    since = _read_watermark(path)
+    if since is None:
+        _save_export(path, iter_latest(), fmt, watermark)
+        return -1
+    codenames = list(session.execute(queries.latest_updates_codenames(since)).scalars())
+    if not codenames:
+        return 0
+    entries: Dict[str, List[dict]] = {}
+    for item in _load_export(path, fmt) or []:
+        if item["codename"] not in codenames:
+            entries.setdefault(item["codename"], []).append(item)
+    for item in session.execute(queries.latest_updates(LATEST_BRANCHES, by_codename=True, codenames=codenames)):
+        entries.setdefault(item.codename, []).append(_latest_item(item))
+    _save_export(path, (item for codename in sorted(entries) for item in entries[codename]), fmt, watermark)
+    return len(codenames)
+
+
+def _date_order(item: dict) -> Tuple[bool, str]:
+    # newest date first and missing dates last once sorted in reverse, as in ORDER BY date DESC
+    return item["date"] is not None, str(item["date"])
+
+
+@tagged
+def export_firmware_delta(path: Union[str, Path], fmt: str = 'yaml') -> int:
+    """
+    Update a firmware updates export file with the updates inserted since it was last written,
+    keyed by md5 (or filename), so that it has the same entries in the same order as a full export.
+    Without a previous export, a full export is written. Firmware updates changed in place are not
+    tracked: remove the watermark file to force a full export after changing them.
+    :param path: export file path
+    :param fmt: yaml or json
+    :return: number of new or changed updates, -1 for a full export
+    """
+    path = Path(path)
+    session = get_session()
+    watermark = session.execute(queries.max_inserted_on(FirmwareUpdate)).scalar()
+    since = _read_watermark(path)
+    if since is None:
+        _save_export(path, (_firmware_item(item) for item in iter_all_updates()), fmt, watermark)
+        return -1
+    # same rows as the full export (only the first update without md5), newest first
+    updates = session.execute(queries.firmware_export_updates_since(since)).all()
+    if not updates:
+        return 0
+    entries = {item["md5"] or item["filename"]: item for item in _load_export(path, fmt) or []}
+    new_items = []
+    for update in updates:
+        item = _firmware_item(update)
+        key = item["md5"] or item["filename"]
+        if key in entries:
+            # read again at the watermark, keeps its place
+            entries[key] = item
+        else:
+            new_items.append(item)
+    # the new updates have greater ids than the exported ones: they come first among updates of the same date,
+    # and the stable sort keeps the (date, id) order of both lists otherwise
+    items = sorted([*new_items, *entries.values()], key=_date_order, reverse=True)
+    _save_export(path, items, fmt, watermark)
+    return len(updates)
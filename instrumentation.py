@@ -0,0 +1,204 @@
+"""
+Opt-in query instrumentation
+
+Statements are tagged with the public function that ran them (e.g. database.get_device_roms),
+and counted per function with a latency histogram and rows (the DBAPI cursor rowcount: selected rows
+with MySQL, only affected rows with SQLite). Statements slower than
+a threshold are written to a slow queries log. Nothing is hooked until enable() is called,
+or until the engines (sync and async) are created with instrumentation: true in config.yml.
+
+Public functions are tagged by the @tagged decorator, which sets the tag in a context variable,
+so it also follows async functions into the greenlet that runs their statements.
+
+    instrumentation.enable(slow_query_threshold=0.5, slow_query_log='slow_queries.log')
+    ...
+    instrumentation.dump('queries_stats.json')
+"""
+import atexit
+import json
+import logging
+import os
+import sys
+from bisect import bisect_left
+from contextvars import ContextVar
+from functools import wraps
+from inspect import iscoroutinefunction
+from threading import Lock
+from time import perf_counter
+from types import GeneratorType
+from typing import Callable, Dict, IO, Iterator, Optional, Set, Union
+from weakref import WeakSet
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from . import get_config, get_engine
+
+# Latency histogram buckets upper bounds, in milliseconds
+BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000, 5000, float('inf'))
+
+slow_queries_logger = logging.getLogger(f"{__package__}.slow_queries")
+_lock = Lock()
+_stats: Dict[str, dict] = {}
+_engines: WeakSet = WeakSet()
+_slow_query_threshold: Optional[float] = None
+_dump_files: Set[str] = set()
+# public function running in the current thread or task, set by @tagged
+_tag: ContextVar[Optional[str]] = ContextVar('instrumentation_tag', default=None)
+
+
+def _tag_steps(iterator: Iterator, tag: str) -> Iterator:
+    # the statements of a generator run when it is iterated, tag each step
+    while True:
+        token = _tag.set(tag) if _tag.get() is None else None
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            if token is not None:
+                _tag.reset(token)
+        yield item
+
+
+def tagged(function: Callable) -> Callable:
+    """
+    Tag the statements run by a public function (sync, async or generator) with its module and name.
+    Nested tagged functions keep the tag of the outermost one.
+    """
+    tag = f"{function.__module__.rsplit('.', 1)[-1]}.{function.__name__}"
+    if iscoroutinefunction(function):
+        @wraps(function)
+        async def async_wrapper(*args, **kwargs):
+            if _tag.get() is not None:
+                return await function(*args, **kwargs)
+            token = _tag.set(tag)
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                _tag.reset(token)
+
+        return async_wrapper
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        if _tag.get() is not None:
+            return function(*args, **kwargs)
+        token = _tag.set(tag)
+        try:
+            result = function(*args, **kwargs)
+        finally:
+            _tag.reset(token)
+        return _tag_steps(result, tag) if isinstance(result, GeneratorType) else result
+
+    return wrapper
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._instrumentation = (_tag.get() or 'other', perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    tag, start = getattr(context, '_instrumentation', ('other', None))
+    if start is None:
+        return
+    elapsed = perf_counter() - start
+    rows = cursor.rowcount if cursor.rowcount and cursor.rowcount > 0 else 0
+    with _lock:
+        stats = _stats.setdefault(tag, {"count": 0, "total_ms": 0.0, "max_ms": 0.0, "rows": 0,
+                                        "histogram": [0] * len(BUCKETS_MS)})
+        stats["count"] += 1
+        stats["total_ms"] += elapsed * 1000
+        stats["max_ms"] = max(stats["max_ms"], elapsed * 1000)
+        stats["rows"] += rows
+        stats["histogram"][bisect_left(BUCKETS_MS, elapsed * 1000)] += 1
+    if _slow_query_threshold is not None and elapsed >= _slow_query_threshold:
+        slow_queries_logger.warning("%.3fs %s: %s %r", elapsed, tag, statement, parameters)
+
+
+def is_enabled() -> bool:
+    return bool(_engines)
+
+
+def enable(engine: Optional[Engine] = None, slow_query_threshold: Optional[float] = None,
+           slow_query_log: Optional[str] = None, dump_at_exit: Optional[str] = None):
+    """
+    Start collecting queries stats of an engine. Several engines can be instrumented (e.g. the sync and
+    async ones), they share the stats and the slow queries settings.
+    :param engine: engine to instrument, the package engine by default (use sync_engine for an async engine)
+    :param slow_query_threshold: seconds after which a statement is logged as slow, no slow queries log if None
+    :param slow_query_log: file that receives the slow queries log, the slow_queries logger handlers otherwise
+    :param dump_at_exit: file to dump the stats to when the process exits
+    """
+    global _slow_query_threshold
+    engine = engine or get_engine()
+    _slow_query_threshold = slow_query_threshold
+    if slow_query_log and not any(isinstance(handler, logging.FileHandler)
+                                  and handler.baseFilename == os.path.abspath(slow_query_log)
+                                  for handler in slow_queries_logger.handlers):
+        handler = logging.FileHandler(slow_query_log)
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        slow_queries_logger.addHandler(handler)
+    if dump_at_exit and dump_at_exit not in _dump_files:
+        _dump_files.add(dump_at_exit)
+        atexit.register(dump, dump_at_exit)
+    if engine in _engines:
+        return
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    _engines.add(engine)
+
+
+def enable_from_config(engine: Engine):
+    """
+    Instrument an engine if instrumentation is set in config.yml
+    :param engine: new engine (or the sync_engine of an async engine)
+    """
+    config = get_config()
+    if config.get('instrumentation'):
+        enable(engine, config.get('slow_query_threshold'), config.get('slow_query_log'),
+               config.get('instrumentation_dump'))
+
+
+def disable(engine: Optional[Engine] = None):
+    """
+    Stop collecting queries stats, of an engine or of all of them. Collected stats are kept until reset()
+    """
+    for instrumented in ([engine] if engine is not None else list(_engines)):
+        if instrumented not in _engines:
+            continue
+        event.remove(instrumented, 'before_cursor_execute', _before_cursor_execute)
+        event.remove(instrumented, 'after_cursor_execute', _after_cursor_execute)
+        _engines.discard(instrumented)
+
+
+def reset():
+    with _lock:
+        _stats.clear()
+
+
+def report() -> Dict[str, dict]:
+    """
+    Get the collected stats of each function, slowest total time first
+    :return: dict of function name to count, total/mean/max latency, rows and latency histogram
+    """
+    with _lock:
+        stats = {tag: dict(values, histogram=list(values["histogram"])) for tag, values in _stats.items()}
+    for values in stats.values():
+        values["mean_ms"] = values["total_ms"] / values["count"]
+        values["histogram"] = {f"<={bucket}ms" if bucket != float('inf') else f">{BUCKETS_MS[-2]}ms": count
+                               for bucket, count in zip(BUCKETS_MS, values["histogram"])}
+    return dict(sorted(stats.items(), key=lambda item: item[1]["total_ms"], reverse=True))
+
+
+def dump(output: Union[str, IO[str], None] = None):
+    """
+    Write the collected stats as JSON
+    :param output: file path or text file object, stderr by default
+    """
+    data = json.dumps(report(), indent=2)
+    if output is None or not isinstance(output, str):
+        (output or sys.stderr).write(data + "\n")
+    else:
+        with open(output, 'w') as f:
+            f.write(data + "\n")
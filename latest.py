@@ -0,0 +1,109 @@
+"""
+Maintenance of the updates_latest table, which points to the latest full update of each (codename, branch, method)
+
+Whenever the table exists (it is created by migration 2), it is kept up to date in the same transaction
+as every flush that adds, changes or deletes MIUI updates, and by the bulk writer, whatever the config of
+the writing process. use_latest_table in config.yml only chooses whether queries read from it.
+Create or rebuild it from the updates table with:
+
+    python -m database.latest
+"""
+from typing import Iterable, Optional, Set, Tuple
+from weakref import WeakSet
+
+from sqlalchemy import delete, event, insert, inspect, select, tuple_
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.orm import Session
+
+from . import get_engine
+from .models.latest_update import LatestUpdate
+from .models.miui_update import Update
+from .queries import ranked_updates
+from .utils import IN_CHUNK_SIZE, chunked
+
+Key = Tuple[str, str, str]
+KEY_ATTRIBUTES = ('codename', 'branch', 'method')
+LATEST_COLUMNS = ('codename', 'branch', 'method', 'update_id', 'date')
+# engines whose database has the table, it is looked up again while it doesn't
+_engines_with_table: WeakSet = WeakSet()
+
+
+def _select_latest(*criteria):
+    latest = ranked_updates(
+        (Update.codename, Update.branch, Update.method, Update.id, Update.date), Update.type == "Full", *criteria,
+        partition_by=(Update.codename, Update.branch, Update.method))
+    return select(latest.c.codename, latest.c.branch, latest.c.method, latest.c.id, latest.c.date).where(
+        latest.c.row_number == 1)
+
+
+def latest_table_exists(connection: Connection) -> bool:
+    """
+    Whether the database has the updates_latest table, which must then be maintained by every write
+    :param connection: connection of the current transaction
+    """
+    engine: Engine = connection.engine
+    if engine not in _engines_with_table:
+        if not inspect(connection).has_table(LatestUpdate.__tablename__):
+            return False
+        _engines_with_table.add(engine)
+    return True
+
+
+def refresh_latest(connection: Connection, keys: Iterable[Key]):
+    """
+    Recompute the latest update of some (codename, branch, method) keys from the updates table
+    :param connection: connection of the current transaction
+    :param keys: (codename, branch, method) tuples
+    """
+    table = LatestUpdate.__table__
+    for chunk in chunked(set(keys), IN_CHUNK_SIZE):
+        connection.execute(delete(table).where(tuple_(table.c.codename, table.c.branch, table.c.method).in_(chunk)))
+        connection.execute(insert(table).from_select(
+            LATEST_COLUMNS, _select_latest(tuple_(Update.codename, Update.branch, Update.method).in_(chunk))))
+
+
+def rebuild_latest(connection: Optional[Connection] = None):
+    """
+    Create the updates_latest table if needed and fill it again from the updates table
+    :param connection: connection of the current transaction, a new transaction by default
+    """
+    if connection is None:
+        with get_engine().begin() as connection:
+            return rebuild_latest(connection)
+    table = LatestUpdate.__table__
+    table.create(connection, checkfirst=True)
+    connection.execute(delete(table))
+    connection.execute(insert(table).from_select(LATEST_COLUMNS, _select_latest()))
+
+
+def update_keys(update: Update) -> Set[Key]:
+    """
+    Get the current key of an update, and its key before any unflushed change
+    """
+    state = inspect(update)
+    current = tuple(getattr(update, attribute) for attribute in KEY_ATTRIBUTES)
+    previous = tuple(state.attrs[attribute].history.deleted[0] if state.attrs[attribute].history.deleted
+                     else value for attribute, value in zip(KEY_ATTRIBUTES, current))
+    return {current, previous}
+
+
+@event.listens_for(Session, 'before_flush')
+def _collect_keys(session: Session, flush_context, instances):
+    updates = [instance for instance in (*session.new, *session.dirty, *session.deleted)
+               if isinstance(instance, Update)]
+    if not updates or not latest_table_exists(session.connection()):
+        return
+    keys = session.info.setdefault('latest_keys', set())
+    for update in updates:
+        keys.update(update_keys(update))
+
+
+@event.listens_for(Session, 'after_flush')
+def _refresh_keys(session: Session, flush_context):
+    keys = session.info.pop('latest_keys', None)
+    if keys:
+        refresh_latest(session.connection(), keys)
+
+
+if __name__ == '__main__':
+    rebuild_latest()
@@ -0,0 +1,288 @@
+"""
+Versioned schema migrations
+
+Each migration runs once and is recorded in the schema_migrations table. Migrations are idempotent,
+so they can also be applied to a database that already has some of their changes.
+
+    python -m database.migrations          # apply pending migrations, then check the hot queries plans
+    python -m database.migrations explain  # only check the hot queries plans
+    python -m database.migrations check    # check that all migrations apply to a database from before them
+"""
+import sys
+from datetime import date, datetime
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+from sqlalchemy import (Column, INT, VARCHAR, TIMESTAMP, Index, MetaData, Table, bindparam, create_engine, func,
+                        insert, inspect, select, text, update)
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.sql.functions import current_timestamp
+
+from . import get_engine, queries, register_sqlite_functions
+from .latest import rebuild_latest
+from .models.device import Device
+from .models.firmware_update import Update as FirmwareUpdate
+from .models.latest_update import LatestUpdate
+from .models.miui_update import Update
+from .queries import LATEST_BRANCHES
+from .versions import version_key
+
+migrations_metadata = MetaData()
+schema_migrations = Table('schema_migrations', migrations_metadata,
+                          Column('version', INT(), primary_key=True, autoincrement=False),
+                          Column('name', VARCHAR(100), nullable=False),
+                          Column('applied_on', TIMESTAMP(), default=current_timestamp()))
+# Rows updated per statement by the backfill migrations
+BACKFILL_CHUNK_SIZE = 1000
+# Model columns added by migrations, missing from databases created before them
+MIGRATION_COLUMNS = {Update.__tablename__: ('version_key', 'updated_on')}
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    upgrade: Callable[[Connection], None]
+
+
+def _reflected(connection: Connection, model) -> Table:
+    # the table as it is in the database: the model columns added by later migrations, and their
+    # defaults (e.g. updated_on ON UPDATE), must not be part of the statements of earlier ones
+    return Table(model.__tablename__, MetaData(), autoload_with=connection)
+
+
+def _index(model, name: str) -> Index:
+    return next(index for index in model.__table__.indexes if index.name == name)
+
+
+def create_indexes(connection: Connection, *indexes: Index):
+    """
+    Create indexes that don't exist yet
+    """
+    for index in indexes:
+        existing = {item['name'] for item in inspect(connection).get_indexes(index.table.name)}
+        if index.name not in existing:
+            index.create(connection)
+
+
+def _hot_queries_indexes(connection: Connection):
+    create_indexes(connection,
+                   _index(Update, 'ix_updates_codename_branch_type_date'),
+                   _index(Update, 'ix_updates_version_type_method'),
+                   _index(Update, 'ix_updates_branch_type_date'),
+                   _index(FirmwareUpdate, 'ix_firmware_codename_version'))
+
+
+def _latest_table(connection: Connection):
+    # only created here: it is filled by migration 7, once the version_key column that orders it exists
+    LatestUpdate.__table__.create(connection, checkfirst=True)
+
+
+def _firmware_date_index(connection: Connection):
+    # the primary key is part of secondary indexes, so this index also gives the (date, id) keyset order
+    create_indexes(connection, _index(FirmwareUpdate, 'ix_firmware_date'))
+
+
+def _inserted_on_indexes(connection: Connection):
+    create_indexes(connection, _index(Update, 'ix_updates_inserted_on'),
+                   _index(FirmwareUpdate, 'ix_firmware_inserted_on'))
+
+
+def _version_key(connection: Connection):
+    if 'version_key' not in {column['name'] for column in inspect(connection).get_columns(Update.__tablename__)}:
+        connection.execute(text(f"ALTER TABLE {Update.__tablename__} ADD COLUMN version_key BIGINT"))
+    table = _reflected(connection, Update)
+    statement = update(table).where(table.c.id == bindparam('_id')).values(version_key=bindparam('_version_key'))
+    last_id = 0
+    # versions without numbers keep a NULL key, so page by id rather than by version_key IS NULL only
+    while rows := connection.execute(select(table.c.id, table.c.version, table.c.android).where(
+            table.c.version_key == None).where(table.c.id > last_id).order_by(table.c.id).limit(
+            BACKFILL_CHUNK_SIZE)).all():
+        connection.execute(statement, [{'_id': row.id, '_version_key': version_key(row.version, row.android)}
+                                       for row in rows])
+        last_id = rows[-1].id
+    create_indexes(connection, _index(Update, 'ix_updates_codename_version_key'))
+
+
+def _updated_on(connection: Connection):
+    if 'updated_on' not in {column['name'] for column in inspect(connection).get_columns(Update.__tablename__)}:
+        # added without a default first: MySQL would fill the existing rows with the time of the ALTER
+        connection.execute(text(f"ALTER TABLE {Update.__tablename__} ADD COLUMN updated_on TIMESTAMP NULL"))
+    table = _reflected(connection, Update)
+    # existing rows count as changed when they were inserted
+    connection.execute(update(table).where(table.c.updated_on == None).values(updated_on=table.c.inserted_on))
+    if connection.dialect.name == 'mysql':
+        # also set by the server, for the writes that don't go through the model
+        connection.execute(text(f"ALTER TABLE {Update.__tablename__} MODIFY COLUMN updated_on TIMESTAMP NULL "
+                                f"DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP"))
+    create_indexes(connection, _index(Update, 'ix_updates_updated_on'))
+
+
+def _latest_by_version(connection: Connection):
+    # the latest update of each key is now the newest version, not the newest release date
+    rebuild_latest(connection)
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, 'hot queries indexes', _hot_queries_indexes),
+    Migration(2, 'updates_latest table', _latest_table),
+    Migration(3, 'firmware date index', _firmware_date_index),
+    Migration(4, 'inserted_on indexes', _inserted_on_indexes),
+    Migration(5, 'version_key column', _version_key),
+    Migration(6, 'updated_on column', _updated_on),
+    Migration(7, 'updates_latest by version', _latest_by_version),
+]
+
+
+def missing_columns(connection: Connection) -> Dict[str, List[str]]:
+    """
+    Get the model columns that the existing tables don't have yet, added by pending migrations
+    :return: dict of table name to missing columns names, empty when the schema is up to date
+    """
+    inspector = inspect(connection)
+    missing = {}
+    for table in (Update.__table__, FirmwareUpdate.__table__):
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        columns = [column.name for column in table.columns if column.name not in existing]
+        if columns:
+            missing[table.name] = columns
+    return missing
+
+
+def applied_migrations(connection: Connection) -> set:
+    schema_migrations.create(connection, checkfirst=True)
+    return set(connection.execute(select(schema_migrations.c.version)).scalars())
+
+
+def upgrade(engine: Optional[Engine] = None) -> List[Migration]:
+    """
+    Apply the pending migrations, each in its own transaction
+    :param engine: migrated database, the configured one by default
+    :return: applied migrations
+    """
+    engine = engine or get_engine()
+    with engine.begin() as connection:
+        applied = applied_migrations(connection)
+    pending = [migration for migration in MIGRATIONS if migration.version not in applied]
+    for migration in pending:
+        with engine.begin() as connection:
+            migration.upgrade(connection)
+            connection.execute(schema_migrations.insert().values(version=migration.version, name=migration.name))
+    return pending
+
+
+def create_baseline_schema(connection: Connection):
+    """
+    Create the devices, updates and firmware tables as they were before the first migration
+    """
+    metadata = MetaData()
+    for table in (Device.__table__, Update.__table__, FirmwareUpdate.__table__):
+        added = MIGRATION_COLUMNS.get(table.name, ())
+        Table(table.name, metadata, *(Column(column.name, column.type, primary_key=column.primary_key,
+                                             nullable=column.nullable, unique=column.unique)
+                                      for column in table.columns if column.name not in added))
+    metadata.create_all(connection)
+
+
+def check_upgrade() -> List[str]:
+    """
+    Apply all migrations to an in-memory SQLite database with the schema from before them, and check the result
+    :return: problems found, empty when the migrated database matches the models
+    """
+    engine = create_engine('sqlite://')
+    register_sqlite_functions(engine)
+    with engine.begin() as connection:
+        create_baseline_schema(connection)
+        # the older release date is the newer version, so that latest rows are picked by version
+        connection.execute(insert(_reflected(connection, Update)), [
+            {'codename': 'whyred', 'version': version, 'android': '9.0', 'branch': 'Stable', 'type': 'Full',
+             'method': 'Recovery', 'filename': f"miui_WHYREDGlobal_{version}.zip", 'link': '', 'date': release_date,
+             'inserted_on': datetime(2020, 3, 1)}
+            for version, release_date in (('V11.0.3.0.PEIMIXM', date(2020, 2, 1)),
+                                          ('V12.0.1.0.PEIMIXM', date(2020, 1, 1)))])
+    problems = []
+    try:
+        upgrade(engine)
+        with engine.connect() as connection:
+            problems += [f"Table {table} has no {', '.join(columns)} column"
+                         for table, columns in missing_columns(connection).items()]
+            if connection.execute(select(func.count()).where(Update.version_key == None)).scalar():
+                problems.append("version_key is not backfilled")
+            if connection.execute(select(func.count()).where(Update.updated_on == None)).scalar():
+                problems.append("updated_on is not backfilled")
+            latest = connection.execute(select(Update.version).join(
+                LatestUpdate, LatestUpdate.update_id == Update.id)).scalars().all()
+            if latest != ['V12.0.1.0.PEIMIXM']:
+                problems.append(f"updates_latest has {latest} instead of the newest version")
+            problems += [f"{name} does a full scan" for name, full_scans in explain(engine).items() if full_scans]
+    except Exception as e:
+        problems.append(f"Upgrade failed: {e!r}")
+    finally:
+        engine.dispose()
+    return problems
+
+
+# Public queries whose plans are checked by explain(), with sample parameters
+HOT_QUERIES: Dict[str, Callable] = {
+    'get_device_latest_version': lambda: queries.device_latest_version('whyred'),
+    'get_latest_versions': lambda: queries.latest_versions('Stable'),
+    'get_latest_updates': lambda: queries.latest_updates(('Stable',)),
+    'get_all_latest_updates': lambda: queries.latest_updates(LATEST_BRANCHES),
+    'get_device_latest': lambda: queries.device_latest('whyred'),
+    'get_device_roms': lambda: queries.device_roms('whyred'),
+    'get_device_roms_page': lambda: queries.device_roms_page('whyred', (date(2021, 1, 1), 1000), 100),
+    'get_incremental': lambda: queries.incremental('V12.0.1.0.QEIMIXM'),
+    'get_version': lambda: queries.version('whyred', 'Stable'),
+    'get_update': lambda: queries.update('miui_WHYREDGlobal_V12.0.1.0.zip'),
+    'get_update_by_version': lambda: queries.update_by_version('V12.0.1.0.QEIMIXM', 'Recovery'),
+    'iter_new_updates': lambda: queries.inserted_after(Update, (datetime(2021, 1, 1), 1000), 500),
+    'firmware.iter_new_updates': lambda: queries.inserted_after(FirmwareUpdate, (datetime(2021, 1, 1), 1000), 500),
+    'firmware.update_in_db': lambda: queries.firmware_update_count('whyred', 'V12.0.1.0.QEIMIXM'),
+    'firmware.get_updates_page': lambda: queries.firmware_updates_page((date(2021, 1, 1), 1000), 1000),
+}
+# Tables that are too big to be scanned
+INDEXED_TABLES = (Update.__tablename__, FirmwareUpdate.__tablename__)
+
+
+def _full_scans(connection: Connection, sql: str) -> List[str]:
+    """
+    Get the query plan steps of a statement that scan a whole indexed table
+    """
+    if connection.dialect.name == 'sqlite':
+        plan = [row.detail for row in connection.execute(text(f"EXPLAIN QUERY PLAN {sql}"))]
+        return [line for line in plan if line.startswith('SCAN') and 'INDEX' not in line
+                and line.split()[1] in INDEXED_TABLES]
+    rows = connection.execute(text(f"EXPLAIN {sql}")).mappings().all()
+    return [str(dict(row)) for row in rows if row['table'] in INDEXED_TABLES and row['type'] == 'ALL']
+
+
+def explain(engine: Optional[Engine] = None) -> Dict[str, List[str]]:
+    """
+    Check that each hot query uses indexes on the updates and firmware tables
+    :param engine: checked database, the configured one by default
+    :return: full table scans of each query, empty when it only uses indexes
+    """
+    engine = engine or get_engine()
+    report = {}
+    with engine.connect() as connection:
+        for name, statement in HOT_QUERIES.items():
+            sql = str(statement().compile(dialect=engine.dialect, compile_kwargs={'literal_binds': True}))
+            report[name] = _full_scans(connection, sql)
+    return report
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['check']:
+        upgrade_problems = check_upgrade()
+        print('\n'.join(upgrade_problems) or 'OK\tall migrations apply to a database from before them')
+        sys.exit(1 if upgrade_problems else 0)
+    if sys.argv[1:] != ['explain']:
+        for applied_migration in upgrade():
+            print(f"Applied migration {applied_migration.version}: {applied_migration.name}")
+    failed = False
+    for query, full_scans in explain().items():
+        print(f"{'FULL SCAN' if full_scans else 'OK'}\t{query}")
+        for full_scan in full_scans:
+            print(f"\t{full_scan}")
+        failed = failed or bool(full_scans)
+    sys.exit(1 if failed else 0)
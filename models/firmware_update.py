@@ -1,5 +1,5 @@
 """Xiaomi Firmware Updater Database Update model"""
-from sqlalchemy import Column, INT, VARCHAR, CHAR, BIGINT, DATE, TIMESTAMP, ForeignKeyConstraint, Table, TEXT
+from sqlalchemy import Column, INT, VARCHAR, CHAR, BIGINT, DATE, TIMESTAMP, ForeignKeyConstraint, Index, Table, TEXT
 from sqlalchemy.sql.functions import current_timestamp
 
 from . import Base
@@ -22,6 +22,11 @@ class Update(Base):
     osdn_link: str = Column(TEXT(), nullable=True)
     date: str = Column(DATE(), nullable=True)
     inserted_on: str = Column(TIMESTAMP(), default=current_timestamp())
+    __table_args__ = (
+        Index('ix_firmware_codename_version', 'codename', 'version'),
+        Index('ix_firmware_date', 'date'),
+        Index('ix_firmware_inserted_on', 'inserted_on', 'id'),
+    )
 
     def __repr__(self):
         return f"<Update(codename={self.codename}, version={self.version}, branch={self.branch})>"
@@ -44,4 +49,7 @@ def get_table(metadata):
                  Column('osdn_link', TEXT(), nullable=True),
                  Column('date', DATE(), nullable=True),
                  Column('inserted_on', TIMESTAMP(), default=current_timestamp()),
-                 ForeignKeyConstraint(['codename'], ['devices.codename'], use_alter=True))
+                 ForeignKeyConstraint(['codename'], ['devices.codename'], use_alter=True),
+                 Index('ix_firmware_codename_version', 'codename', 'version'),
+                 Index('ix_firmware_date', 'date'),
+                 Index('ix_firmware_inserted_on', 'inserted_on', 'id'))
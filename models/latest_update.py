@@ -0,0 +1,31 @@
+"""MIUI Updates Tracker Database latest update model"""
+from sqlalchemy import Column, INT, VARCHAR, DATE, ForeignKeyConstraint, PrimaryKeyConstraint, Table
+
+from . import Base
+
+
+class LatestUpdate(Base):
+    """
+    LatestUpdate class that points to the latest full update of each (codename, branch, method)
+    """
+    __tablename__ = 'updates_latest'
+    codename: str = Column(VARCHAR(30), primary_key=True)
+    branch: str = Column(VARCHAR(15), primary_key=True)
+    method: str = Column(VARCHAR(8), primary_key=True)
+    update_id: int = Column(INT(), nullable=False)
+    date: str = Column(DATE(), nullable=True)
+    __table_args__ = (ForeignKeyConstraint(['update_id'], ['updates.id'], ondelete="CASCADE"),)
+
+    def __repr__(self):
+        return f"<LatestUpdate(codename={self.codename}, branch={self.branch}, method={self.method})>"
+
+
+def get_table(metadata):
+    return Table('updates_latest', metadata,
+                 Column('codename', VARCHAR(30), nullable=False),
+                 Column('branch', VARCHAR(15), nullable=False),
+                 Column('method', VARCHAR(8), nullable=False),
+                 Column('update_id', INT(), nullable=False),
+                 Column('date', DATE(), nullable=True),
+                 PrimaryKeyConstraint('codename', 'branch', 'method'),
+                 ForeignKeyConstraint(['update_id'], ['updates.id'], ondelete="CASCADE"))
@@ -1,8 +1,11 @@
 """MIUI Updates Tracker Database Update model"""
-from sqlalchemy import Column, INT, VARCHAR, CHAR, BIGINT, DATE, TIMESTAMP, ForeignKeyConstraint, Table, TEXT
+from sqlalchemy import (Column, INT, VARCHAR, CHAR, BIGINT, DATE, TIMESTAMP, ForeignKeyConstraint, Index, Table, TEXT,
+                        event, inspect)
+from sqlalchemy.orm import Session
 from sqlalchemy.sql.functions import current_timestamp
 
 from . import Base
+from ..versions import version_key, version_key_default
 
 
 class Update(Base):
@@ -24,6 +27,16 @@ class Update(Base):
     changelog: str = Column(TEXT(), nullable=True, default='Bug fixes and system optimizations.')
     date: str = Column(DATE(), nullable=True)
     inserted_on: str = Column(TIMESTAMP(), default=current_timestamp())
+    version_key: int = Column(BIGINT(), nullable=True, default=version_key_default)
+    updated_on: str = Column(TIMESTAMP(), nullable=True, default=current_timestamp(), onupdate=current_timestamp())
+    __table_args__ = (
+        Index('ix_updates_codename_branch_type_date', 'codename', 'branch', 'type', 'date'),
+        Index('ix_updates_version_type_method', 'version', 'type', 'method'),
+        Index('ix_updates_branch_type_date', 'branch', 'type', 'date'),
+        Index('ix_updates_inserted_on', 'inserted_on', 'id'),
+        Index('ix_updates_codename_version_key', 'codename', 'version_key'),
+        Index('ix_updates_updated_on', 'updated_on'),
+    )
 
     def __repr__(self):
         return f"<Update(codename={self.codename}, version={self.version}, branch={self.branch}, method={self.method})>"
@@ -32,6 +45,17 @@ class Update(Base):
         return str({k: v for k, v in self.__dict__.items() if not k.startswith("_")})
 
 
+@event.listens_for(Session, 'before_flush')
+def _update_version_keys(session: Session, flush_context, instances):
+    # the insert default doesn't apply to changed updates: recompute the key when its columns change
+    for instance in session.dirty:
+        if not isinstance(instance, Update):
+            continue
+        state = inspect(instance)
+        if state.attrs.version.history.has_changes() or state.attrs.android.history.has_changes():
+            instance.version_key = version_key(instance.version, instance.android)
+
+
 def get_table(metadata):
     return Table('updates', metadata,
                  Column('id', INT(), primary_key=True, autoincrement=True),
@@ -48,4 +72,13 @@ def get_table(metadata):
                  Column('changelog', TEXT(), nullable=True, default='Bug fixes and system optimizations.'),
                  Column('date', DATE(), nullable=True),
                  Column('inserted_on', TIMESTAMP(), default=current_timestamp()),
-                 ForeignKeyConstraint(['codename'], ['devices.codename']))
+                 Column('version_key', BIGINT(), nullable=True, default=version_key_default),
+                 Column('updated_on', TIMESTAMP(), nullable=True, default=current_timestamp(),
+                        onupdate=current_timestamp()),
+                 ForeignKeyConstraint(['codename'], ['devices.codename']),
+                 Index('ix_updates_codename_branch_type_date', 'codename', 'branch', 'type', 'date'),
+                 Index('ix_updates_version_type_method', 'version', 'type', 'method'),
+                 Index('ix_updates_branch_type_date', 'branch', 'type', 'date'),
+                 Index('ix_updates_inserted_on', 'inserted_on', 'id'),
+                 Index('ix_updates_codename_version_key', 'codename', 'version_key'),
+                 Index('ix_updates_updated_on', 'updated_on'))
@@ -0,0 +1,365 @@
+"""
+Query statements shared by the sync and async database functions
+"""
+from datetime import date, datetime
+from typing import List, Optional, Tuple, Type, Union
+
+from sqlalchemy import Select, and_, bindparam, case, literal, or_, select, tuple_
+from sqlalchemy.sql.functions import concat, func
+
+from . import get_config
+from .models.device import Device
+from .models.firmware_update import Update as FirmwareUpdate
+from .models.latest_update import LatestUpdate
+from .models.miui_update import Update
+
+# Branches exported as "latest" updates, in their export order
+LATEST_BRANCHES = ("Stable Beta", "Stable", "Weekly", "Public Beta")
+
+# Devices that have a "main" MIUI code, used to skip variants in listings
+MAIN_MIUI_CODE = or_(func.length(Device.miui_code) == 4, Device.miui_code.endswith("RF"),
+                     Device.miui_code.endswith("FK"))
+# Branches of the updates listed on devices pages
+DEVICE_BRANCHES = or_(Update.branch.startswith("Stable"), Update.branch == "Weekly", Update.branch == "Public Beta")
+DEVICE_UPDATE_COLUMNS = (Update.codename, Update.version, Update.android, Update.branch, Update.method,
+                         Update.filename, Update.size, Update.md5, Update.link, Update.changelog, Update.date)
+# Keyset pagination cursor: (date, id) of the last row of the previous page
+Cursor = Tuple[Optional[date], int]
+# Change feed cursor: (inserted_on, id) of the last row read
+FeedCursor = Tuple[datetime, int]
+# Codenames from first (included) to end (excluded), None for no bound
+CodenameRange = Tuple[Optional[str], Optional[str]]
+LATEST_UPDATE_COLUMNS = (Update.codename, Update.version, Update.android, Update.branch,
+                         Update.method, Update.size, Update.md5, Update.link, Update.changelog, Update.date)
+
+
+def use_latest_table() -> bool:
+    """
+    Whether latest updates are read from the maintained updates_latest table (see latest.py)
+    """
+    return bool(get_config().get('use_latest_table'))
+
+
+def codename_prefix(codename: str):
+    """
+    codename LIKE 'codename%', with a constant pattern so that the codename index can be used
+    (startswith() renders LIKE :codename || '%')
+    """
+    return Update.codename.like(f"{codename}%")
+
+
+def keyset_after(date_column, id_column, cursor: Cursor):
+    """
+    Rows that come after a cursor in ORDER BY date DESC, id DESC order, where NULL dates come last.
+    Spelled out with OR instead of a row comparison, so that MySQL can use indexes.
+    """
+    date_, id_ = cursor
+    if date_ is None:
+        return and_(date_column == None, id_column < id_)
+    return or_(date_column < date_, and_(date_column == date_, id_column < id_), date_column == None)
+
+
+def mi_website_ids() -> Select:
+    return select(Device.mi_website_id, Device.region).where(Device.mi_website_id != None).where(
+        Device.eol != 1).group_by(Device.mi_website_id)
+
+
+def fastboot_codenames() -> Select:
+    return select(Device.codename, Device.region).where(Device.mi_website_id != None).where(
+        Device.eol != 1).order_by(Device.codename)
+
+
+def current_devices() -> Select:
+    return select(Device.codename).where(Device.eol == "0").where(Device.miui_code != "").where(MAIN_MIUI_CODE)
+
+
+def in_codename_range(column, codename_range: Optional[CodenameRange]) -> list:
+    """
+    Criteria of the codenames in a [first, end) range, None bounds being open
+    """
+    if codename_range is None:
+        return []
+    first, end = codename_range
+    return [criterion for criterion in (column >= first if first is not None else None,
+                                        column < end if end is not None else None) if criterion is not None]
+
+
+def devices(codename_range: Optional[CodenameRange] = None) -> Select:
+    return select(
+        Device.codename, concat(Device.name, ' ', Device.region).label('name'), Device.miui_name
+    ).where(Device.miui_code != "").where(MAIN_MIUI_CODE).where(
+        *in_codename_range(Device.codename, codename_range)).order_by(Device.codename)
+
+
+def device_codenames() -> Select:
+    return select(Device.codename).distinct().order_by(Device.codename)
+
+
+# Newest build first: parsed version key (see versions.py), then release date for unparsed versions.
+# Used by every query that picks the latest update(s), so that they all agree on which one it is.
+NEWEST_VERSION_FIRST = (Update.version_key.desc(), Update.date.desc(), Update.id.desc())
+
+
+def device_latest_version(codename: str) -> Select:
+    return select(Update.codename, Update.version, Update.android).where(
+        Update.codename == codename).where(Update.branch.startswith("Stable")).where(
+        Update.type == "Full").order_by(*NEWEST_VERSION_FIRST).limit(1)
+
+
+def devices_latest_version(codenames: List[str]) -> Select:
+    """
+    Same as device_latest_version, for several codenames at once
+    """
+    latest = ranked_updates((Update.codename, Update.version, Update.android), Update.codename.in_(codenames),
+                            Update.branch.startswith("Stable"), Update.type == "Full", partition_by=(Update.codename,))
+    return select(latest.c.codename, latest.c.version, latest.c.android).where(latest.c.row_number == 1)
+
+
+def ranked_updates(columns, *criteria, partition_by, order_by=None):
+    """
+    Rank updates matching the criteria with ROW_NUMBER() OVER (PARTITION BY ... ORDER BY version_key DESC,
+    date DESC, id DESC), so that the newest row of each partition has row_number = 1
+    :param columns: update columns to select
+    :param criteria: filters applied to the updates table
+    :param partition_by: columns identifying a "latest" group
+    :param order_by: ranking order, NEWEST_VERSION_FIRST by default
+    :return: subquery with the selected columns and a row_number column
+    """
+    row_number = func.row_number().over(
+        partition_by=partition_by, order_by=order_by or NEWEST_VERSION_FIRST).label('row_number')
+    return select(*columns, row_number).where(*criteria).subquery()
+
+
+def latest_table_updates(columns, *criteria):
+    """
+    Same as ranked_updates, for updates of the updates_latest table (all with row_number = 1)
+    """
+    return select(*columns, literal(1).label('row_number')).join(
+        LatestUpdate, LatestUpdate.update_id == Update.id).where(*criteria).subquery()
+
+
+def latest_versions(branch: str) -> Select:
+    if use_latest_table():
+        # rank the few latest updates of each device instead of its whole history
+        row_number = func.row_number().over(
+            partition_by=LatestUpdate.codename, order_by=NEWEST_VERSION_FIRST).label('row_number')
+        latest = select(Update.codename, Update.version, Update.android, row_number).join(
+            LatestUpdate, LatestUpdate.update_id == Update.id).where(LatestUpdate.branch.startswith(branch)).subquery()
+    else:
+        latest = ranked_updates(
+            (Update.codename, Update.version, Update.android),
+            Update.branch.startswith(branch), Update.type == "Full", partition_by=(Update.codename,))
+    return select(latest.c.codename, latest.c.version, latest.c.android).where(
+        latest.c.row_number == 1).where(latest.c.codename == Device.codename).where(
+        Device.eol == '0').where(Device.miui_code != "").where(MAIN_MIUI_CODE)
+
+
+def latest_updates(branches: Tuple[str, ...], by_codename: bool = False,
+                   codenames: Optional[List[str]] = None, codename_range: Optional[CodenameRange] = None) -> Select:
+    """
+    Latest update of each (codename, method, branch) of the given branches, ordered by the branches order then by date
+    :param branches: branches to select
+    :param by_codename: order by codename first
+    :param codenames: only select these codenames
+    :param codename_range: only select the codenames of a [first, end) range
+    """
+    criteria = [Update.branch.in_(branches), Update.type == "Full", *in_codename_range(Update.codename, codename_range)]
+    if codenames is not None:
+        criteria.append(Update.codename.in_(codenames))
+    latest = latest_table_updates(LATEST_UPDATE_COLUMNS, *criteria) if use_latest_table() else ranked_updates(
+        LATEST_UPDATE_COLUMNS, *criteria, partition_by=(Update.codename, Update.method, Update.branch))
+    order_by = [latest.c.date.desc()]
+    if len(branches) > 1:
+        order_by.insert(0, case({branch: index for index, branch in enumerate(branches)}, value=latest.c.branch))
+    if by_codename:
+        order_by.insert(0, latest.c.codename)
+    return select(
+        Device.name, concat(Device.name, ' ', Device.region).label('fullname'),
+        *(latest.c[column.key] for column in LATEST_UPDATE_COLUMNS)).where(latest.c.row_number == 1).where(
+        latest.c.codename == Device.codename).where(Device.miui_code != "").where(MAIN_MIUI_CODE).order_by(*order_by)
+
+
+def device_latest(codename: str) -> Select:
+    return _device_latest(codename_prefix(codename))
+
+
+def devices_latest(codenames: List[str]) -> Select:
+    """
+    Same as device_latest, for the codenames that start with any of the given codenames
+    """
+    return _device_latest(or_(*(codename_prefix(codename) for codename in codenames)))
+
+
+def _device_latest(codename_criterion) -> Select:
+    criteria = (codename_criterion, DEVICE_BRANCHES, Update.type == "Full")
+    latest = latest_table_updates(DEVICE_UPDATE_COLUMNS, *criteria) if use_latest_table() else ranked_updates(
+        DEVICE_UPDATE_COLUMNS, *criteria, partition_by=(Update.codename, Update.method, Update.branch))
+    return select(
+        concat(Device.name, ' ', Device.region).label('name'),
+        *(latest.c[column.key] for column in DEVICE_UPDATE_COLUMNS)).where(latest.c.row_number == 1).where(
+        Device.codename == latest.c.codename).where(MAIN_MIUI_CODE)
+
+
+def device_roms(codename: str) -> Select:
+    all_updates = select(*DEVICE_UPDATE_COLUMNS).where(codename_prefix(codename)).where(DEVICE_BRANCHES).where(
+        Update.type == "Full").order_by(Update.date.desc()).limit(99999).subquery()
+    return select(concat(Device.name, ' ', Device.region).label('name'), all_updates).where(
+        Device.codename == all_updates.c.codename).where(MAIN_MIUI_CODE)
+
+
+def device_roms_page(codename: str, cursor: Optional[Cursor], page_size: int) -> Select:
+    """
+    Same rows as device_roms, with the update id, one keyset page at a time
+    :param codename: device codename prefix
+    :param cursor: (date, id) of the last row of the previous page, None for the first page
+    :param page_size: maximum number of rows
+    """
+    statement = select(concat(Device.name, ' ', Device.region).label('name'), *DEVICE_UPDATE_COLUMNS, Update.id).where(
+        Device.codename == Update.codename).where(codename_prefix(codename)).where(DEVICE_BRANCHES).where(
+        Update.type == "Full").where(MAIN_MIUI_CODE)
+    if cursor is not None:
+        statement = statement.where(keyset_after(Update.date, Update.id, cursor))
+    return statement.order_by(Update.date.desc(), Update.id.desc()).limit(page_size)
+
+
+def device_by_codename(codename: str) -> Select:
+    return select(Device).where(Device.codename == codename).limit(1)
+
+
+def device_by_miui_name(miui_name: str) -> Select:
+    return select(Device).where(Device.miui_name == miui_name).limit(1)
+
+
+def device_by_miui_code(miui_code: str) -> Select:
+    return select(Device).where(Device.miui_code == miui_code).limit(1)
+
+
+def incremental(version: str) -> Select:
+    return select(Update).where(Update.version == version).where(Update.type == "Incremental").limit(1)
+
+
+def version(codename: str, branch: str) -> Select:
+    return select(Update.version).where(Update.codename == codename).where(Update.branch == branch).order_by(
+        *NEWEST_VERSION_FIRST).limit(1)
+
+
+def update_count(filename: str) -> Select:
+    return select(func.count()).select_from(Update).where(Update.filename == filename)
+
+
+def existing_filenames(filenames: List[str]) -> Select:
+    return select(Update.filename).where(Update.filename.in_(filenames))
+
+
+def update(filename: str) -> Select:
+    return select(Update).where(Update.filename == filename).limit(1)
+
+
+def update_by_version(version_: str, method: str) -> Select:
+    return select(Update).where(Update.version == version_).where(
+        Update.method == method).where(Update.type == "Full").limit(1)
+
+
+def latest_updates_codenames(since: datetime) -> Select:
+    """
+    Codenames that have updates inserted or changed since a date. Any change counts, even to a
+    branch that is not exported, since it can remove the update from the export.
+    """
+    return select(Update.codename).where(Update.updated_on >= since).distinct()
+
+
+def inserted_after(model: Type[Union[Update, FirmwareUpdate]], cursor: FeedCursor, limit: int) -> Select:
+    """
+    Rows of a table inserted after a change feed cursor, in (inserted_on, id) order
+    """
+    inserted_on, id_ = cursor
+    return select(*model.__table__.columns).where(
+        or_(model.inserted_on > inserted_on, and_(model.inserted_on == inserted_on, model.id > id_))).order_by(
+        model.inserted_on, model.id).limit(limit)
+
+
+def max_inserted_on(model: Type[Union[Update, FirmwareUpdate]]) -> Select:
+    return select(func.max(model.inserted_on))
+
+
+def max_updated_on() -> Select:
+    return select(func.max(Update.updated_on))
+
+
+def cache_version() -> Select:
+    """
+    Cheap version of the cached results: newest update updated_on and devices count
+    """
+    return select(select(func.max(Update.updated_on)).scalar_subquery(),
+                  select(func.count()).select_from(Device).scalar_subquery())
+
+
+def firmware_current_devices() -> Select:
+    return select(Device.codename).where(Device.firmware_updater == 1).order_by(Device.codename)
+
+
+def firmware_update_count(codename: str, version_: str) -> Select:
+    return select(func.count()).select_from(FirmwareUpdate).where(
+        FirmwareUpdate.codename == codename).where(FirmwareUpdate.version == version_)
+
+
+def firmware_existing_updates(updates: List[Tuple[str, str]]) -> Select:
+    return select(FirmwareUpdate.codename, FirmwareUpdate.version).where(
+        tuple_(FirmwareUpdate.codename, FirmwareUpdate.version).in_(updates))
+
+
+def firmware_all_updates() -> Select:
+    return select(
+        concat(Device.name, ' ', Device.region).label('name'), FirmwareUpdate.codename, FirmwareUpdate.version,
+        FirmwareUpdate.android, FirmwareUpdate.branch, FirmwareUpdate.filename, FirmwareUpdate.size,
+        FirmwareUpdate.md5, FirmwareUpdate.date
+    ).join(Device, FirmwareUpdate.codename == Device.codename).group_by(FirmwareUpdate.md5)
+
+
+def firmware_updates_since(since: datetime) -> Select:
+    return firmware_all_updates().where(FirmwareUpdate.inserted_on >= since)
+
+
+def firmware_export_updates() -> Select:
+    """
+    Same rows as firmware_all_updates, with the update id, newest first (ORDER BY date DESC, id DESC).
+    md5 is unique, so GROUP BY md5 only merges updates without md5: the first one of them is kept
+    instead, which doesn't depend on the pages or the rows that are read.
+    """
+    first_without_md5 = select(func.min(FirmwareUpdate.id)).where(FirmwareUpdate.md5 == None).scalar_subquery()
+    return select(
+        concat(Device.name, ' ', Device.region).label('name'), FirmwareUpdate.codename, FirmwareUpdate.version,
+        FirmwareUpdate.android, FirmwareUpdate.branch, FirmwareUpdate.filename, FirmwareUpdate.size,
+        FirmwareUpdate.md5, FirmwareUpdate.date, FirmwareUpdate.id
+    ).join(Device, FirmwareUpdate.codename == Device.codename).where(
+        or_(FirmwareUpdate.md5 != None, FirmwareUpdate.id == first_without_md5)).order_by(
+        FirmwareUpdate.date.desc(), FirmwareUpdate.id.desc())
+
+
+def firmware_updates_page(cursor: Optional[Cursor], page_size: int) -> Select:
+    """
+    firmware_export_updates rows, one keyset page at a time
+    :param cursor: (date, id) of the last row of the previous page, None for the first page
+    :param page_size: maximum number of rows
+    """
+    statement = firmware_export_updates()
+    if cursor is not None:
+        statement = statement.where(keyset_after(FirmwareUpdate.date, FirmwareUpdate.id, cursor))
+    return statement.limit(page_size)
+
+
+def firmware_export_updates_since(since: datetime) -> Select:
+    """
+    firmware_export_updates rows inserted since a date
+    """
+    return firmware_export_updates().where(FirmwareUpdate.inserted_on >= since)
+
+
+# Statements of the hot single row lookups, built once with bound parameters and executed with their values,
+# e.g. session.execute(UPDATE_BY_FILENAME, {'filename': filename}): they skip building the statement
+# and computing its compiled SQL cache key on each call
+DEVICE_LATEST_VERSION = device_latest_version(bindparam('codename'))
+UPDATE_BY_FILENAME = update(bindparam('filename'))
+UPDATE_BY_VERSION = update_by_version(bindparam('version'), bindparam('method'))
+INCREMENTAL = incremental(bindparam('version'))
+FIRMWARE_UPDATE_COUNT = firmware_update_count(bindparam('codename'), bindparam('version'))
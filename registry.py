@@ -0,0 +1,93 @@
+"""
+In-memory devices registry
+"""
+from threading import Lock
+from time import monotonic
+from typing import Dict, List, Optional
+
+from . import Session, get_config, get_engine
+from .models.device import Device
+
+
+class DeviceRegistry:
+    """
+    Cache of the devices table, indexed by codename, miui_name and miui_code.
+    The table is loaded once and reloaded after ttl seconds, or on the next lookup after invalidate().
+    Cached Device objects are detached from any session and shared by all threads, so they must not be
+    modified: database functions return copies of them (detached objects or read-only rows) instead.
+    """
+
+    def __init__(self, ttl: Optional[float] = None):
+        """
+        :param ttl: seconds before the devices are reloaded, device_registry_ttl from config.yml by default
+        """
+        self._ttl = ttl
+        self._loaded_at: Optional[float] = None
+        # incremented on each load, so that derived indexes know when to refresh
+        self.version = 0
+        self._lock = Lock()
+        self._devices: List[Device] = []
+        self._by_codename: Dict[str, Device] = {}
+        self._by_miui_name: Dict[str, Device] = {}
+        self._by_miui_code: Dict[str, Device] = {}
+
+    @property
+    def ttl(self) -> float:
+        if self._ttl is None:
+            self._ttl = get_config().get('device_registry_ttl', 300)
+        return self._ttl
+
+    def load(self):
+        """
+        Load all devices from the database
+        """
+        get_engine()
+        with Session() as session:
+            devices = session.query(Device).order_by(Device.id).all()
+            session.expunge_all()
+        by_codename, by_miui_name, by_miui_code = {}, {}, {}
+        # keep the first device by id for each key, like an unordered .first() query would
+        for device in devices:
+            by_codename.setdefault(device.codename, device)
+            by_miui_name.setdefault(device.miui_name, device)
+            by_miui_code.setdefault(device.miui_code, device)
+        self._devices = devices
+        self._by_codename, self._by_miui_name, self._by_miui_code = by_codename, by_miui_name, by_miui_code
+        self._loaded_at = monotonic()
+        self.version += 1
+
+    def invalidate(self):
+        """
+        Reload the devices on the next lookup
+        """
+        self._loaded_at = None
+
+    def _ensure_loaded(self):
+        if self._loaded_at is not None and monotonic() - self._loaded_at < self.ttl:
+            return
+        with self._lock:
+            if self._loaded_at is None or monotonic() - self._loaded_at >= self.ttl:
+                self.load()
+
+    @property
+    def devices(self) -> List[Device]:
+        self._ensure_loaded()
+        return self._devices
+
+    def get(self, codename: str) -> Optional[Device]:
+        self._ensure_loaded()
+        return self._by_codename.get(codename)
+
+    def get_by_miui_name(self, miui_name: str) -> Optional[Device]:
+        self._ensure_loaded()
+        return self._by_miui_name.get(miui_name)
+
+    def get_by_miui_code(self, miui_code: str) -> Optional[Device]:
+        self._ensure_loaded()
+        return self._by_miui_code.get(miui_code)
+
+    def __contains__(self, codename: str) -> bool:
+        return self.get(codename) is not None
+
+
+device_registry = DeviceRegistry()
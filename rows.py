@@ -0,0 +1,99 @@
+"""
+Read-only rows, returned instead of ORM objects when read_only_rows is set in config.yml
+
+Rows are immutable named tuples selected with Core statements, so they are never added to
+a session identity map and are released as soon as the caller drops them.
+"""
+from datetime import date, datetime
+from functools import lru_cache
+from typing import NamedTuple, Optional, Type, Union
+
+from sqlalchemy import Select
+
+from . import get_config
+from .models import Base
+from .models.device import Device
+from .models.firmware_update import Update as FirmwareUpdate
+from .models.miui_update import Update
+
+
+class UpdateRow(NamedTuple):
+    id: int
+    codename: str
+    version: str
+    android: str
+    branch: str
+    type: str
+    method: str
+    size: Optional[int]
+    md5: Optional[str]
+    filename: Optional[str]
+    link: str
+    changelog: Optional[str]
+    date: Optional[date]
+    inserted_on: Optional[datetime]
+    version_key: Optional[int]
+    updated_on: Optional[datetime]
+
+
+class FirmwareRow(NamedTuple):
+    id: int
+    codename: str
+    version: str
+    android: str
+    branch: str
+    size: Optional[int]
+    md5: Optional[str]
+    filename: Optional[str]
+    github_link: str
+    osdn_link: Optional[str]
+    date: Optional[date]
+    inserted_on: Optional[datetime]
+
+
+class DeviceRow(NamedTuple):
+    id: int
+    name: Optional[str]
+    codename: str
+    region: Optional[str]
+    miui_name: Optional[str]
+    miui_code: Optional[str]
+    mi_website_id: Optional[int]
+    picture: Optional[str]
+    eol: Optional[bool]
+    firmware_updater: bool
+
+
+ROW_TYPES = {
+    Update: UpdateRow,
+    FirmwareUpdate: FirmwareRow,
+    Device: DeviceRow,
+}
+
+
+def read_only_rows() -> bool:
+    """
+    Whether single object lookups return read-only rows instead of ORM objects
+    """
+    return bool(get_config().get('read_only_rows'))
+
+
+@lru_cache(maxsize=32)
+def row_statement(statement: Select, model: Type[Base]) -> Select:
+    """
+    Same statement, selecting the table columns of the model instead of the model entity.
+    Cached, so that the prepared statements of queries.py stay the same objects.
+    """
+    return statement.with_only_columns(*model.__table__.columns)
+
+
+def to_row(item, model: Type[Base]) -> Union[UpdateRow, FirmwareRow, DeviceRow, None]:
+    """
+    Convert a Core result row or an ORM object to the read-only row type of its model
+    """
+    if item is None:
+        return None
+    row_type = ROW_TYPES[model]
+    if isinstance(item, Base):
+        return row_type(*(getattr(item, field) for field in row_type._fields))
+    return row_type(**item._asdict())
@@ -0,0 +1,247 @@
+"""
+In-memory devices search index
+
+Devices are indexed by the terms of their codename, name, miui_name and miui_code: the lowercase
+field values and the words of the name. A query matches the terms it is a prefix of, and when there
+are not enough prefix matches, the terms that share enough trigrams with it (fuzzy matching).
+Results are ranked by score (match kind, field weight and term length), then matched term, then codename.
+
+Prefix matches are found without scoring every completion: terms are kept in sorted lists per
+(field weight, term length), whose completions all have the same score, and these lists are read
+best score first until enough devices are found. Trigrams are indexed per (term trigrams count,
+field weight) band, which bounds the score of its terms: fuzzy matching reads the bands best score
+first, stops when the next ones can't beat the matches found, and only reads the trigram lists
+a term must be in to beat them.
+
+The index follows the device registry: when the registry reloads, only the devices that were
+added, changed or removed since the previous refresh are re-indexed.
+"""
+import heapq
+from bisect import bisect_left, insort
+from collections import Counter
+from itertools import chain, islice
+from math import ceil
+from threading import Lock
+from typing import Dict, FrozenSet, Iterator, List, Optional, Set, Tuple
+
+from .models.device import Device
+from .registry import DeviceRegistry, device_registry
+
+# Ranking weight of each indexed field
+FIELD_WEIGHTS = {
+    'codename': 3,
+    'miui_name': 2,
+    'miui_code': 2,
+    'name': 1,
+}
+# Minimum trigram similarity (Dice coefficient) of a fuzzy match
+MIN_SIMILARITY = 0.4
+_NO_TERMS: FrozenSet[str] = frozenset()
+
+# (negated score, matched term): the best match of a device is the smallest
+Match = Tuple[float, str]
+
+
+def normalize(text: Optional[str]) -> str:
+    return ' '.join(str(text).lower().split()) if text else ''
+
+
+def trigrams(term: str) -> Set[str]:
+    padded = f"  {term} "
+    return {padded[index:index + 3] for index in range(len(padded) - 2)}
+
+
+def device_terms(device: Device) -> Dict[str, int]:
+    """
+    Get the indexed terms of a device with their weight
+    """
+    terms: Dict[str, int] = {}
+    for field, weight in FIELD_WEIGHTS.items():
+        value = normalize(getattr(device, field))
+        if not value:
+            continue
+        for term in {value, *value.split(), value.replace(' ', '')}:
+            terms[term] = max(terms.get(term, 0), weight)
+    return terms
+
+
+class DeviceSearchIndex:
+    """
+    Prefix and trigram index of the devices of a registry
+    """
+
+    def __init__(self, registry: DeviceRegistry = device_registry):
+        self._registry = registry
+        self._version: Optional[int] = None
+        self._lock = Lock()
+        self._devices: Dict[int, Device] = {}
+        self._codenames: Dict[int, str] = {}
+        self._device_terms: Dict[int, Dict[str, int]] = {}
+        # (term, weight) -> sorted (codename, device id) of the devices that have the term in a field of that weight
+        self._term_devices: Dict[Tuple[str, int], List[Tuple[str, int]]] = {}
+        # (weight, term length) -> sorted terms, and weight -> sorted lengths of these lists
+        self._terms: Dict[Tuple[int, int], List[str]] = {}
+        self._lengths: Dict[int, List[int]] = {}
+        # (trigram, term trigrams count, weight) -> terms, and number of terms of each (count, weight) band
+        self._trigrams: Dict[Tuple[str, int, int], Set[str]] = {}
+        self._bands: Counter = Counter()
+
+    def _add_term(self, term: str, weight: int):
+        key = (weight, len(term))
+        if key not in self._terms:
+            self._terms[key] = []
+            insort(self._lengths.setdefault(weight, []), len(term))
+        insort(self._terms[key], term)
+        term_trigrams = trigrams(term)
+        self._bands[(len(term_trigrams), weight)] += 1
+        for trigram in term_trigrams:
+            self._trigrams.setdefault((trigram, len(term_trigrams), weight), set()).add(term)
+
+    def _remove_term(self, term: str, weight: int):
+        key = (weight, len(term))
+        terms = self._terms[key]
+        del terms[bisect_left(terms, term)]
+        if not terms:
+            del self._terms[key]
+            lengths = self._lengths[weight]
+            del lengths[bisect_left(lengths, len(term))]
+        term_trigrams = trigrams(term)
+        band = (len(term_trigrams), weight)
+        self._bands[band] -= 1
+        if not self._bands[band]:
+            del self._bands[band]
+        for trigram in term_trigrams:
+            key = (trigram, *band)
+            self._trigrams[key].discard(term)
+            if not self._trigrams[key]:
+                del self._trigrams[key]
+
+    def _add(self, device: Device):
+        terms = device_terms(device)
+        self._devices[device.id] = device
+        self._codenames[device.id] = device.codename
+        self._device_terms[device.id] = terms
+        for term, weight in terms.items():
+            if (term, weight) not in self._term_devices:
+                self._term_devices[(term, weight)] = []
+                self._add_term(term, weight)
+            insort(self._term_devices[(term, weight)], (device.codename, device.id))
+
+    def _remove(self, device_id: int):
+        del self._devices[device_id]
+        codename = self._codenames.pop(device_id)
+        for term, weight in self._device_terms.pop(device_id).items():
+            devices = self._term_devices[(term, weight)]
+            del devices[bisect_left(devices, (codename, device_id))]
+            if not devices:
+                del self._term_devices[(term, weight)]
+                self._remove_term(term, weight)
+
+    def refresh(self):
+        """
+        Re-index the devices that changed since the last refresh, if the registry was reloaded
+        """
+        devices = self._registry.devices
+        if self._version == self._registry.version:
+            return
+        with self._lock:
+            if self._version == self._registry.version:
+                return
+            current = {device.id: device for device in devices}
+            for device_id in [device_id for device_id in self._devices if device_id not in current]:
+                self._remove(device_id)
+            for device_id, device in current.items():
+                if device_id in self._devices:
+                    if device_terms(device) == self._device_terms[device_id]:
+                        # same terms, only keep the new object
+                        self._devices[device_id] = device
+                        continue
+                    self._remove(device_id)
+                self._add(device)
+            self._version = self._registry.version
+
+    def _prefix_matches(self, query: str, limit: int) -> Dict[int, Match]:
+        # the terms of a (weight, length) list that start with the query all have the same score:
+        # read the lists best score first, and stop once limit devices are found
+        groups: List[Tuple[float, int, int]] = []
+        for weight, lengths in self._lengths.items():
+            for length in lengths[bisect_left(lengths, len(query)):]:
+                # exact matches first, then the shortest completions
+                score = 100 if length == len(query) else 50 + 10 * len(query) / length
+                groups.append((score * weight, weight, length))
+        groups.sort(reverse=True)
+        matches: Dict[int, Match] = {}
+        for score, weight, length in groups:
+            terms = self._terms[(weight, length)]
+            index = bisect_left(terms, query)
+            while index < len(terms) and terms[index].startswith(query):
+                term = terms[index]
+                # devices are sorted by codename, and met best match first
+                for _, device_id in self._term_devices[(term, weight)]:
+                    if device_id not in matches:
+                        matches[device_id] = (-score, term)
+                        if len(matches) >= limit:
+                            return matches
+                index += 1
+        return matches
+
+    def _band_matches(self, query_trigrams: Set[str], count: int, weight: int,
+                      min_similarity: float) -> Iterator[Tuple[Match, int]]:
+        # fuzzy matches of the terms of count trigrams and of a field weight, best first: the terms
+        # sharing the most trigrams with the query, which are found by reading the fewest lists
+        lists = sorted((self._trigrams.get((trigram, count, weight), _NO_TERMS) for trigram in query_trigrams),
+                       key=len)
+        least = ceil(min_similarity * (len(query_trigrams) + count) / 2 - 1e-9)
+        for needed in range(min(count, len(query_trigrams)), least - 1, -1):
+            # a term sharing needed trigrams is in one of the (query trigrams - needed + 1) shortest lists,
+            # the other ones are only intersected with these terms
+            scanned = len(query_trigrams) - needed + 1
+            shared = Counter(chain.from_iterable(lists[:scanned]))
+            candidates = set(shared)
+            for terms in lists[scanned:]:
+                shared.update(candidates & terms)
+            score = -40 * weight * 2 * needed / (len(query_trigrams) + count)
+            for term in sorted(term for term, shared_count in shared.items() if shared_count == needed):
+                for _, device_id in self._term_devices[(term, weight)]:
+                    yield (score, term), device_id
+
+    def _add_fuzzy_matches(self, query: str, limit: int, matches: Dict[int, Match]) -> Dict[int, Match]:
+        query_trigrams = trigrams(query)
+        matches = dict(matches)
+        # best score of the terms of each band, reached when they share all their (or the query) trigrams
+        bands = sorted(((40 * weight * 2 * min(count, len(query_trigrams)) / (len(query_trigrams) + count),
+                         count, weight) for count, weight in self._bands), reverse=True)
+        for best_score, count, weight in bands:
+            # score to reach to be in the results
+            worst_score = -heapq.nsmallest(limit, matches.values())[-1][0] if len(matches) >= limit else 0
+            if best_score < worst_score:
+                break
+            min_similarity = max(MIN_SIMILARITY, worst_score / (40 * weight))
+            # the devices after the first limit ones of a band are behind them
+            for match, device_id in islice(self._band_matches(query_trigrams, count, weight, min_similarity), limit):
+                if match < matches.get(device_id, (0,)):
+                    matches[device_id] = match
+        return matches
+
+    def search(self, query: str, limit: int = 10) -> List[Device]:
+        """
+        Find the devices matching a query
+        :param query: part of a codename, name, MIUI name or MIUI code, typos allowed
+        :param limit: maximum number of devices
+        :return: devices, best matches first
+        """
+        query = normalize(query)
+        if not query:
+            return []
+        self.refresh()
+        with self._lock:
+            matches = self._prefix_matches(query, limit)
+            if len(matches) < limit and len(query) >= 3:
+                matches = self._add_fuzzy_matches(query, limit, matches)
+            ranked: List[Tuple[float, str, str, int]] = heapq.nsmallest(
+                limit, ((score, term, self._codenames[device_id], device_id)
+                        for device_id, (score, term) in matches.items()))
+            return [self._devices[device_id] for _, _, _, device_id in ranked]
+
+
+device_index = DeviceSearchIndex()
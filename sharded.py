@@ -0,0 +1,141 @@
+"""
+Parallel sharded exports
+
+The latest updates export is split by branch and by codename range, and the devices export by
+codename range. Each shard is exported by a worker process with its own engine, which writes the
+shard file (shards/<shard>.<format>) and its serialized items with their sort key
+(shards/<shard>.parts). The combined latest.<format> and devices.<format> files are then merged
+from the parts in key order, without serializing the items again.
+
+    python -m database.sharded exports/ --workers 8 --format json
+"""
+import argparse
+import heapq
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from math import ceil
+from pathlib import Path
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+from . import configure, get_config, get_session, queries, reset_after_fork
+from .helpers import EXPORT_CHUNK_SIZE, dict_fragment, iter_devices, iter_latest, list_fragment, write_fragments
+from .queries import LATEST_BRANCHES, CodenameRange
+
+BRANCH_ORDER = {branch: index for index, branch in enumerate(LATEST_BRANCHES)}
+
+
+class Shard(NamedTuple):
+    kind: str
+    name: str
+    branch: Optional[str]
+    codename_range: CodenameRange
+
+
+def codename_ranges(count: int) -> List[CodenameRange]:
+    """
+    Split the devices codenames into ranges of about the same number of codenames
+    :param count: number of ranges
+    :return: [first, end) ranges, the first and last ones being open
+    """
+    codenames = list(get_session().execute(queries.device_codenames()).scalars())
+    step = max(ceil(len(codenames) / count), 1)
+    bounds = [None, *codenames[step::step], None]
+    return list(zip(bounds, bounds[1:]))
+
+
+def shards(ranges: List[CodenameRange]) -> List[Shard]:
+    latest = [Shard('latest', f"latest_{branch.lower().replace(' ', '_')}_{index:03d}", branch, codename_range)
+              for branch in LATEST_BRANCHES for index, codename_range in enumerate(ranges)]
+    devices = [Shard('devices', f"devices_{index:03d}", None, codename_range)
+               for index, codename_range in enumerate(ranges)]
+    return latest + devices
+
+
+def _init_worker(config: dict):
+    reset_after_fork()
+    configure(**config)
+
+
+def _shard_items(shard: Shard, fmt: str) -> Iterator[Tuple[list, str]]:
+    """
+    Serialized items of a shard with their sort key in the combined export
+    """
+    if shard.kind == 'latest':
+        for item in iter_latest(EXPORT_CHUNK_SIZE, (shard.branch,), shard.codename_range):
+            yield [item["codename"], BRANCH_ORDER[item["branch"]]], list_fragment(item, fmt)
+    else:
+        for codename, value in iter_devices(EXPORT_CHUNK_SIZE, shard.codename_range):
+            yield [codename], dict_fragment(codename, value, fmt)
+
+
+def export_shard(shard: Shard, directory: Path, fmt: str) -> int:
+    """
+    Write the file and the parts of a shard
+    :return: number of items
+    """
+    count = 0
+    with open(directory / f"{shard.name}.parts", 'w') as parts_file:
+        def fragments():
+            nonlocal count
+            for key, fragment in _shard_items(shard, fmt):
+                parts_file.write(json.dumps([key, fragment]) + '\n')
+                count += 1
+                yield fragment
+
+        with open(directory / f"{shard.name}.{fmt}", 'w') as f:
+            write_fragments(fragments(), f, fmt, '[]' if shard.kind == 'latest' else '{}')
+    return count
+
+
+def _read_parts(path: Path) -> Iterator[Tuple[list, str]]:
+    with open(path) as f:
+        for line in f:
+            yield tuple(json.loads(line))
+
+
+def merge_parts(paths: List[Path], output: Path, fmt: str, brackets: str):
+    """
+    Merge shards parts by key into a combined export file. Items with the same key come from
+    the same shard, so they keep their order.
+    """
+    merged = heapq.merge(*(_read_parts(path) for path in paths), key=lambda part: part[0])
+    temporary_file = output.with_name(f"{output.name}.tmp")
+    with open(temporary_file, 'w') as f:
+        write_fragments((fragment for _, fragment in merged), f, fmt, brackets)
+    os.replace(temporary_file, output)
+
+
+def export_sharded(directory: Union[str, Path], fmt: str = 'yaml', workers: Optional[int] = None,
+                   ranges: Optional[int] = None) -> Dict[str, int]:
+    """
+    Export the latest updates and the devices with a pool of worker processes
+    :param directory: output directory, shards are written to its shards subdirectory
+    :param fmt: yaml or json
+    :param workers: number of processes, the number of CPUs by default
+    :param ranges: number of codename ranges, the number of workers by default
+    :return: number of items of each shard
+    """
+    directory = Path(directory)
+    shards_directory = directory / 'shards'
+    shards_directory.mkdir(parents=True, exist_ok=True)
+    workers = workers or os.cpu_count()
+    all_shards = shards(codename_ranges(ranges or workers))
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(dict(get_config()),)) as executor:
+        futures = {shard: executor.submit(export_shard, shard, shards_directory, fmt) for shard in all_shards}
+        counts = {shard.name: future.result() for shard, future in futures.items()}
+    for kind, brackets in (('latest', '[]'), ('devices', '{}')):
+        merge_parts([shards_directory / f"{shard.name}.parts" for shard in all_shards if shard.kind == kind],
+                    directory / f"{kind}.{fmt}", fmt, brackets)
+    return counts
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('directory', help="output directory")
+    parser.add_argument('--format', default='yaml', choices=('yaml', 'json'))
+    parser.add_argument('--workers', type=int, help="number of processes, the number of CPUs by default")
+    parser.add_argument('--ranges', type=int, help="number of codename ranges, the number of workers by default")
+    options = parser.parse_args()
+    shard_counts = export_sharded(options.directory, options.format, options.workers, options.ranges)
+    print(f"Exported {sum(shard_counts.values())} items in {len(shard_counts)} shards")
@@ -0,0 +1,107 @@
+"""
+Offline snapshots of the tracker data
+
+A snapshot is an indexed SQLite file with the devices, updates and firmware tables (and a filled
+updates_latest table). Write one from the configured database with:
+
+    python -m database.snapshot tracker.db
+
+Then read it with the usual database.py, firmware.py and helpers.py functions, without any
+SSH tunnel, by setting in config.yml:
+
+    snapshot: /path/to/tracker.db
+
+The file is opened read-only and immutable, and memory-mapped (snapshot_mmap_size bytes).
+"""
+import os
+import sys
+from pathlib import Path
+from typing import Dict, Optional, Union
+
+from sqlalchemy import create_engine, event, insert, select
+from sqlalchemy.engine import Engine
+
+from . import get_config, get_engine
+from .latest import rebuild_latest
+from .models.device import Device
+from .models.firmware_update import Update as FirmwareUpdate
+from .models.miui_update import Update
+
+SNAPSHOT_TABLES = (Device.__table__, Update.__table__, FirmwareUpdate.__table__)
+# Rows copied per round trip
+SNAPSHOT_CHUNK_SIZE = 5000
+DEFAULT_MMAP_SIZE = 256 * 1024 * 1024
+
+
+def snapshot_url(path: Union[str, Path]) -> str:
+    """
+    Get the read-only connection URL of a snapshot file
+    """
+    return f"sqlite:///file:{Path(path).resolve()}?mode=ro&immutable=1&uri=true"
+
+
+def register_snapshot_pragmas(engine: Engine, mmap_size: Optional[int] = None):
+    """
+    Memory-map snapshot files and refuse writes on every new connection
+    :param engine: snapshot engine (or the sync_engine of an async engine)
+    :param mmap_size: bytes to map, snapshot_mmap_size from config.yml by default
+    """
+    if mmap_size is None:
+        mmap_size = get_config().get('snapshot_mmap_size') or DEFAULT_MMAP_SIZE
+
+    @event.listens_for(engine, 'connect')
+    def _connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA mmap_size={int(mmap_size)}")
+        cursor.execute("PRAGMA query_only=1")
+        cursor.close()
+
+
+def _fast_load(dbapi_connection, connection_record):
+    # the file is written to a temporary path and only renamed when complete, so no journal is needed
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=OFF")
+    cursor.execute("PRAGMA synchronous=OFF")
+    cursor.close()
+
+
+def create_snapshot(path: Union[str, Path], source: Optional[Engine] = None,
+                    chunk_size: int = SNAPSHOT_CHUNK_SIZE) -> Dict[str, int]:
+    """
+    Copy the devices, updates and firmware tables to a new SQLite file, replacing it atomically
+    :param path: snapshot file path
+    :param source: engine to copy from, the configured database by default
+    :param chunk_size: rows fetched and inserted at a time
+    :return: number of rows copied per table
+    """
+    path = Path(path)
+    temporary_file = path.with_name(f"{path.name}.tmp")
+    temporary_file.unlink(missing_ok=True)
+    target = create_engine(f"sqlite:///{temporary_file.resolve()}")
+    event.listen(target, 'connect', _fast_load)
+    counts = {}
+    try:
+        with (source or get_engine()).connect() as source_connection, target.begin() as target_connection:
+            for table in SNAPSHOT_TABLES:
+                table.create(target_connection)
+                result = source_connection.execution_options(yield_per=chunk_size).execute(
+                    select(table).order_by(table.c.id))
+                counts[table.name] = 0
+                for rows in result.partitions():
+                    target_connection.execute(insert(table), [row._asdict() for row in rows])
+                    counts[table.name] += len(rows)
+            rebuild_latest(target_connection)
+        with target.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            connection.exec_driver_sql("ANALYZE")
+            connection.exec_driver_sql("VACUUM")
+    finally:
+        target.dispose()
+    os.replace(temporary_file, path)
+    return counts
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        sys.exit(f"Usage: python -m {__package__}.snapshot <snapshot file>")
+    for table_name, count in create_snapshot(sys.argv[1]).items():
+        print(f"{table_name}: {count} rows")
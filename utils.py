@@ -0,0 +1,38 @@
+"""
+Internal utility functions
+"""
+from itertools import islice
+from typing import Callable, Iterable, Iterator, List, Optional, Sequence, Tuple, TypeVar
+
+T = TypeVar('T')
+
+# Maximum number of values in a single IN (...) clause
+IN_CHUNK_SIZE = 500
+
+
+def chunked(iterable: Iterable[T], size: int) -> Iterator[List[T]]:
+    """
+    Split an iterable into lists of at most size items
+    :param iterable: items to split
+    :param size: maximum chunk size
+    :return: iterator of lists
+    """
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def iter_keyset(fetch_page: Callable[[Optional[Tuple]], Sequence[T]], page_size: int) -> Iterator[T]:
+    """
+    Iterate over keyset pages, each fetched with the (date, id) cursor of the previous page's last row
+    :param fetch_page: function that returns a page of at most page_size rows after a cursor (None for the first page)
+    :param page_size: rows per page
+    :return: iterator of rows
+    """
+    cursor = None
+    while True:
+        page = fetch_page(cursor)
+        yield from page
+        if len(page) < page_size:
+            return
+        cursor = (page[-1].date, page[-1].id)
@@ -0,0 +1,48 @@
+"""
+Sortable version keys
+
+Versions like V14.0.3.0.TKHMIXM, OS1.0.5.0.UNCMIXM or 23.1.1 (weekly builds) are stored as text,
+which doesn't sort numerically. version_key() packs the android version and the numeric parts of
+a version into an integer, so that a greater key is a newer build:
+
+    android major | scheme (weekly < V < OS) | major | minor | patch | build
+
+The region and branch letters of the version (TKHMIXM) don't order builds, so they are not part of the key.
+"""
+import re
+from typing import Optional
+
+# Bits of each field, from the most to the least significant one
+VERSION_KEY_FIELDS = (('android', 7), ('scheme', 2), ('major', 8), ('minor', 8), ('patch', 10), ('build', 10))
+VERSION_SCHEMES = {'': 0, 'V': 1, 'OS': 2}
+
+_version_pattern = re.compile(r'^(OS|V)?(\d+(?:\.\d+)*)')
+
+
+def version_key(version: Optional[str], android: Optional[str] = None) -> Optional[int]:
+    """
+    Get the sortable key of a version
+    :param version: MIUI, HyperOS or weekly version
+    :param android: android version, e.g. 13.0
+    :return: integer key, None if the version has no numeric part
+    """
+    match = _version_pattern.match(version or '')
+    if not match:
+        return None
+    numbers = [int(part) for part in match.group(2).split('.')[:4]]
+    android_match = re.match(r'\d+', android or '')
+    values = {'android': int(android_match.group()) if android_match else 0,
+              'scheme': VERSION_SCHEMES[match.group(1) or ''],
+              **dict(zip(('major', 'minor', 'patch', 'build'), numbers))}
+    key = 0
+    for field, bits in VERSION_KEY_FIELDS:
+        key = (key << bits) | min(values.get(field, 0), (1 << bits) - 1)
+    return key
+
+
+def version_key_default(context) -> Optional[int]:
+    """
+    Column default computing version_key from the version and android values of the inserted row
+    """
+    parameters = context.get_current_parameters()
+    return version_key(parameters.get('version'), parameters.get('android'))